@@ -0,0 +1,2 @@
+# Offline benchmarks of the model stack on synthetic data (no dataset downloads nor pretrained vectors needed).
+#   python -m benchmarks.model_bench --device cpu --output model_bench.json
@@ -0,0 +1,289 @@
+# Memory and throughput scaling curves of the unsupervised training step (opt_step on a batch without labels), where the
+# IW losses (IWLBo) duplicate the inference and generation passes over training_iw_samples importance samples while
+# ELBo does a single pass. For every combination of the given losses, IW sample counts (only for IW losses), batch
+# sizes, max lengths, --divide_by model scales (as in sent_train.py) and vocabulary sizes, a fresh process builds the
+# model on CPU, and records:
+#   - peak_rss_mb: the process' peak resident memory, rss_before_mb the one after building the model, before training,
+#     and training_rss_mb the difference, which is what the training step itself costs
+#   - parameters_mb, optimizer_state_mb and activations_mb: the model's parameters, the optimizer's moments, and the
+#     tensors kept for the backward pass by one step, with activations broken down by vertex of the inference and
+#     generation networks (the rest being attributed to the opt_step phase saving it, e.g. the losses)
+#   - samples_per_s and tokens_per_s of opt_step
+# Results are written as JSON and as a csv table. --budget_mb prints, for each setting of everything but the batch size,
+# the fastest batch size fitting in the memory budget and the --grad_accu giving --effective_batch_size with it.
+# --plot draws the curves (requires matplotlib).
+# Examples:
+#   python -m benchmarks.iw_scaling --iw_samples 2 5 10 --batch_sizes 4 8 16 32 --max_lens 64 --budget_mb 8000
+#   python -m benchmarks.iw_scaling --divide_by 1 2 4 --vocab_sizes 10000 50000 --plot iw_scaling.png
+import argparse
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import platform
+import resource
+import shutil
+import traceback
+from collections import defaultdict
+from time import perf_counter, strftime
+
+import torch
+
+from benchmarks.model_bench import git_commit
+from benchmarks.synthetic import vocabularies, zipf_batches, build_model, IW_LOSSES
+from sentence_classification.models import NullTimer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--graph", default='sentiment', choices=['sentiment', 'postag'], type=str)
+parser.add_argument("--losses", default=['SSVAE', 'SSIWAE'], nargs='*', type=str)  # ELBo and IWLBo
+parser.add_argument("--iw_samples", default=[2, 5, 10], nargs='*', type=int)
+parser.add_argument("--batch_sizes", default=[8, 32], nargs='*', type=int)
+parser.add_argument("--max_lens", default=[64, 256], nargs='*', type=int)
+parser.add_argument("--divide_by", default=[1, 2], nargs='*', type=int)
+parser.add_argument("--vocab_sizes", default=[20000], nargs='*', type=int)
+parser.add_argument("--n_tags", default=2, type=int)
+parser.add_argument("--steps", default=5, type=int)  # timed calls of opt_step
+parser.add_argument("--warmup", default=1, type=int)  # untimed calls before
+parser.add_argument("--threads", default=None, type=int)  # torch threads of the measuring processes
+# Model dimensions before --divide_by, sent_train.py's defaults
+parser.add_argument("--embedding_dim", default=300, type=int)
+parser.add_argument("--pos_embedding_dim", default=50, type=int)
+parser.add_argument("--z_size", default=100, type=int)
+parser.add_argument("--text_rep_h", default=200, type=int)
+parser.add_argument("--encoder_h", default=200, type=int)
+parser.add_argument("--encoder_l", default=2, type=int)
+parser.add_argument("--pos_h", default=50, type=int)
+parser.add_argument("--pos_l", default=2, type=int)
+parser.add_argument("--decoder_h", default=200, type=int)
+parser.add_argument("--decoder_l", default=1, type=int)
+parser.add_argument("--budget_mb", default=None, type=float)
+parser.add_argument("--effective_batch_size", default=64, type=int)  # batch_size x grad_accu to reach
+parser.add_argument("--output", default='iw_scaling.json', type=str)
+parser.add_argument("--table", default='iw_scaling.csv', type=str)
+parser.add_argument("--plot", default=None, type=str)
+
+# Dimensions divided by --divide_by in sent_train.py
+DIVIDED = ['embedding_dim', 'z_size', 'pos_h', 'pos_embedding_dim', 'encoder_h', 'decoder_h']
+TABLE_COLUMNS = ['losses', 'training_iw_samples', 'batch_size', 'max_len', 'divide_by', 'vocab_size', 'peak_rss_mb',
+                 'rss_before_mb', 'training_rss_mb', 'parameters_mb', 'optimizer_state_mb', 'activations_mb', 'samples_per_s',
+                 'tokens_per_s']
+
+
+def rss_peak_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def tensors_mb(tensors):
+    storages = {t.untyped_storage().data_ptr(): t.untyped_storage().nbytes() for t in tensors}
+    return sum(storages.values()) / 2**20
+
+
+class ActivationRecorder:
+    # Sizes of the tensors saved for the backward pass during a step (each storage counted once, parameters excluded),
+    # by vertex of the networks it is attached to as a vertex hook, or else by opt_step phase, as the model's timer
+    def __init__(self, nets, parameters):
+        self.nets = nets
+        self.parameters = {p.untyped_storage().data_ptr() for p in parameters}
+        self.seen = set()
+        self.vertex, self.pending = None, 0
+        self.sizes = defaultdict(int)
+        for net in nets:
+            net.vertex_hooks.append(self)
+
+    def detach(self):
+        for net in self.nets:
+            net.vertex_hooks.remove(self)
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self.parameters and storage.data_ptr() not in self.seen:
+            self.seen.add(storage.data_ptr())
+            if self.vertex is not None:
+                self.sizes[self.vertex] += storage.nbytes()
+            else:
+                self.pending += storage.nbytes()
+        return tensor
+
+    def before_vertex(self, net, lv, dp_lvl):
+        self.vertex = '{}: {} -> {}'.format(self.nets[net], ', '.join(p.name for p in net.parent[lv]), lv.name)
+
+    def after_vertex(self, net, lv, dp_lvl):
+        self.vertex = None
+
+    # Timer interface (see StepTimer): what was saved outside of the vertices goes to the phase that just ended
+    def start(self):
+        self.pending = 0
+
+    def lap(self, name):
+        if self.pending:
+            self.sizes[name] += self.pending
+        self.pending = 0
+
+    def add(self, name, seconds):
+        pass
+
+    def step(self, n_tokens, step):
+        pass
+
+    def breakdown_mb(self):
+        return {name: size / 2**20 for name, size in sorted(self.sizes.items(), key=lambda item: -item[1])}
+
+
+def configurations(flags):
+    for losses, batch_size, max_len, divide_by, vocab_size in itertools.product(flags.losses, flags.batch_sizes,
+                                                                                flags.max_lens, flags.divide_by,
+                                                                                flags.vocab_sizes):
+        for iw_samples in (flags.iw_samples if losses in IW_LOSSES else [1]):
+            yield {'losses': losses, 'training_iw_samples': iw_samples, 'batch_size': batch_size, 'max_len': max_len,
+                   'divide_by': divide_by, 'vocab_size': vocab_size}
+
+
+def measure(config, flags):
+    # Runs in its own process so that the peak RSS is this configuration's
+    if flags.threads is not None:
+        torch.set_num_threads(flags.threads)
+    device = torch.device('cpu')
+    vocab, tags = vocabularies(config['vocab_size'], flags.n_tags)
+    dims = {name: getattr(flags, name) for name in ['embedding_dim', 'pos_embedding_dim', 'z_size', 'text_rep_h',
+                                                    'encoder_h', 'encoder_l', 'pos_h', 'pos_l', 'decoder_h',
+                                                    'decoder_l']}
+    for name in DIVIDED:
+        dims[name] = int(dims[name] / config['divide_by'])
+    model = build_model(vocab, tags, flags.graph, config['losses'], config['batch_size'], config['max_len'],
+                        config['training_iw_samples'], device, tied_embeddings=False, **dims)
+    batches = zipf_batches(vocab, tags, flags.warmup + flags.steps + 1, config['batch_size'], config['max_len'],
+                           flags.graph == 'postag', device)
+    samples = [{'x': batch.text[..., 1:], 'x_prev': batch.text[..., :-1]} for batch in batches]
+    tokens = [int((batch.text != vocab.stoi['<pad>']).sum()) for batch in batches]
+    model.train()
+    result = dict(config, rss_before_mb=rss_peak_mb())
+
+    # One recorded step, before the timed ones since the hooks slow it down
+    recorder = ActivationRecorder({model.infer_bn: 'inference', model.gen_bn: 'generation'}, model.parameters())
+    model.timer = recorder
+    with torch.autograd.graph.saved_tensors_hooks(recorder.pack, lambda tensor: tensor):
+        model.opt_step(samples[-1])
+    recorder.detach()
+    model.timer = NullTimer()
+    result['activations'] = recorder.breakdown_mb()
+    result['activations_mb'] = sum(result['activations'].values())
+
+    for step in range(flags.warmup):
+        model.opt_step(samples[step])
+    start = perf_counter()
+    for step in range(flags.warmup, flags.warmup + flags.steps):
+        model.opt_step(samples[step])
+    duration = perf_counter() - start
+    result['samples_per_s'] = config['batch_size'] * flags.steps / duration
+    result['tokens_per_s'] = sum(tokens[flags.warmup:flags.warmup + flags.steps]) / duration
+    result['parameters_mb'] = tensors_mb(list(model.parameters()))
+    result['optimizer_state_mb'] = tensors_mb([v for state in model.optimizer.state.values() for v in state.values()
+                                               if torch.is_tensor(v)])
+    result['peak_rss_mb'] = rss_peak_mb()
+    result['training_rss_mb'] = result['peak_rss_mb'] - result['rss_before_mb']
+    model.writer.close()
+    shutil.rmtree(model.h_params.viz_path, ignore_errors=True)
+    return result
+
+
+def measure_safely(config, flags):
+    # A failing configuration (e.g. out of memory) is reported and the others still run
+    try:
+        return measure(config, flags)
+    except Exception:
+        traceback.print_exc()
+        return dict(config, error=traceback.format_exc(limit=3))
+
+
+def recommendations(results, budget_mb, effective_batch_size):
+    # For each setting of everything but the batch size: the batch size with the highest throughput among those whose
+    # peak memory fits in the budget, and the gradient accumulation steps reaching the effective batch size with it
+    groups = defaultdict(list)
+    for result in results:
+        if 'error' not in result and result['peak_rss_mb'] <= budget_mb:
+            groups[tuple(result[k] for k in ['losses', 'training_iw_samples', 'max_len', 'divide_by',
+                                             'vocab_size'])].append(result)
+    best = [max(group, key=lambda result: result['samples_per_s']) for group in groups.values()]
+    return [dict(result, grad_accu=int(math.ceil(effective_batch_size / result['batch_size']))) for result in best]
+
+
+def write_table(results, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, TABLE_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            if 'error' not in result:
+                writer.writerow({k: round(v, 2) if isinstance(v, float) else v for k, v in result.items()})
+
+
+def plot(results, path):
+    # Peak RSS and samples/s against the batch size, one line per (loss, IW samples), one column of plots per max_len
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    results = [r for r in results if 'error' not in r]
+    max_lens = sorted({r['max_len'] for r in results})
+    figure, axes = plt.subplots(2, len(max_lens), figsize=(6 * len(max_lens), 8), squeeze=False)
+    lines = defaultdict(list)
+    for result in results:
+        lines[(result['max_len'], result['losses'], result['training_iw_samples'], result['divide_by'],
+               result['vocab_size'])].append(result)
+    for (max_len, losses, iw_samples, divide_by, vocab_size), line in sorted(lines.items()):
+        line = sorted(line, key=lambda result: result['batch_size'])
+        column = max_lens.index(max_len)
+        label = '{} iw={} /{} V={}'.format(losses, iw_samples, divide_by, vocab_size)
+        for row, metric in enumerate(['peak_rss_mb', 'samples_per_s']):
+            axes[row][column].plot([r['batch_size'] for r in line], [r[metric] for r in line], marker='o', label=label)
+            axes[row][column].set_xlabel('batch_size')
+            axes[row][column].set_ylabel(metric)
+            axes[row][column].set_title('max_len={}'.format(max_len))
+    axes[0][0].legend(fontsize='small')
+    figure.tight_layout()
+    figure.savefig(path)
+
+
+def main():
+    flags = parser.parse_args()
+    if flags.plot is not None:
+        # Fails before the measurements rather than after them if matplotlib is missing
+        import matplotlib
+    report = {'commit': git_commit(), 'date': strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__,
+              'python': platform.python_version(), 'device_name': platform.processor(),
+              'threads': flags.threads or torch.get_num_threads(), 'flags': vars(flags), 'results': []}
+    # A fresh interpreter per configuration (forked processes would inherit this one's peak RSS)
+    context = multiprocessing.get_context('spawn')
+    for config in configurations(flags):
+        print("Measuring ", config)
+        with context.Pool(1) as pool:
+            result = pool.apply(measure_safely, (config, flags))
+        if 'error' in result:
+            print("Failed: ", config)
+        else:
+            print("peak RSS {:.0f} MB, activations {:.0f} MB, {:.2f} samples/s".format(
+                result['peak_rss_mb'], result['activations_mb'], result['samples_per_s']))
+        report['results'].append(result)
+    with open(flags.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    write_table(report['results'], flags.table)
+    print("Results written to {} and {}".format(flags.output, flags.table))
+
+    if flags.budget_mb is not None:
+        print("Fastest batch size within {:.0f} MB for an effective batch size of {}:".format(
+            flags.budget_mb, flags.effective_batch_size))
+        row = '{:<8} {:>4} {:>8} {:>6} {:>8} {:>11} {:>10} {:>12} {:>10}'
+        print(row.format('losses', 'iw', 'max_len', 'div', 'vocab', 'batch_size', 'grad_accu', 'peak_rss_mb',
+                         'samples/s'))
+        for result in sorted(recommendations(report['results'], flags.budget_mb, flags.effective_batch_size),
+                             key=lambda result: -result['samples_per_s']):
+            print(row.format(result['losses'], result['training_iw_samples'], result['max_len'], result['divide_by'],
+                             result['vocab_size'], result['batch_size'], result['grad_accu'],
+                             '{:.0f}'.format(result['peak_rss_mb']), '{:.2f}'.format(result['samples_per_s'])))
+    if flags.plot is not None:
+        plot(report['results'], flags.plot)
+        print("Curves drawn in ", flags.plot)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+# Times the forward and backward passes of each link (components/links.py) and of each latent variable path
+# (components/latent_variables.py: _forward through an MLPLink, _sequential_forward through a GRULink) on random inputs,
+# for every combination of the given batch sizes, sequence lengths, hidden sizes and IW sample counts. IW samples are
+# laid out as the BayesNet does it: the inputs are expanded along a leading dimension of size iw_samples.
+# Results are written as JSON. With --baseline, they are compared to those of a previous run (its output file), and
+# the script exits with status 1 if any benchmark got slower than the baseline by more than --tolerance.
+# Examples:
+#   python -m benchmarks.micro_bench --device cpu --batch_sizes 8 --max_lens 32 --output micro_bench.json
+#   python -m benchmarks.micro_bench --device cuda:0 --baseline micro_bench_main.json --tolerance 0.1
+import argparse
+import itertools
+import json
+import platform
+import sys
+import traceback
+from time import perf_counter, strftime
+
+import torch
+import torch.nn as nn
+
+from benchmarks.model_bench import synchronize, git_commit
+from components.links import MLPLink, LastStateMLPLink, LSTMLink, GRULink, TransformerLink, \
+    CoattentiveTransformerLink, ConditionalCoattentiveTransformerLink
+from components.latent_variables import Gaussian, Categorical, MultiCategorical, MultiEmbedding
+
+LINKS = ['MLPLink', 'LastStateMLPLink', 'LSTMLink', 'GRULink', 'TransformerLink', 'CoattentiveTransformerLink',
+         'ConditionalCoattentiveTransformerLink']
+VARIABLES = ['Gaussian', 'Categorical', 'MultiCategorical']
+PATHS = ['_forward', '_sequential_forward']
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--device", default='cpu', type=str)
+parser.add_argument("--links", default=LINKS, nargs='*', choices=LINKS, type=str)
+parser.add_argument("--variables", default=VARIABLES, nargs='*', choices=VARIABLES, type=str)
+parser.add_argument("--paths", default=PATHS, nargs='*', choices=PATHS, type=str)
+parser.add_argument("--batch_sizes", default=[8, 32], nargs='*', type=int)
+parser.add_argument("--max_lens", default=[32, 128], nargs='*', type=int)
+parser.add_argument("--hidden_sizes", default=[128, 512], nargs='*', type=int)
+parser.add_argument("--iw_samples", default=[1, 5], nargs='*', type=int)
+parser.add_argument("--input_size", default=300, type=int)
+parser.add_argument("--z_size", default=64, type=int)  # also the number of classes of the categorical variables
+parser.add_argument("--depth", default=2, type=int)
+parser.add_argument("--n_targets", default=4, type=int)  # targets/memories of the coattentive transformer links
+parser.add_argument("--n_disc", default=4, type=int)  # sub-variables of MultiCategorical
+parser.add_argument("--embedding_dim", default=64, type=int)  # of Categorical
+parser.add_argument("--steps", default=10, type=int)  # timed calls of each benchmark
+parser.add_argument("--warmup", default=2, type=int)  # untimed calls before
+parser.add_argument("--output", default='micro_bench.json', type=str)
+parser.add_argument("--baseline", default=None, type=str)  # output of a previous run to compare against
+parser.add_argument("--tolerance", default=0.2, type=float)  # allowed relative slowdown before failing
+
+
+def stats(durations):
+    return {'mean_ms': sum(durations) / len(durations), 'min_ms': min(durations), 'max_ms': max(durations)}
+
+
+def saved_activations_mb(forward):
+    # Size of the tensors kept by autograd for the backward pass (each storage counted once), which is the part of the
+    # memory that scales with the batch and doesn't depend on the device
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[(tensor.device, storage.data_ptr())] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        forward()
+    return sum(storages.values()) / 2**20
+
+
+def time_forward_backward(forward, n_warmup, n_steps, device):
+    # Milliseconds of the forward call and of the backward pass of the sum of its outputs, timed separately
+    def backward(outputs):
+        sum(o.float().sum() for o in outputs).backward()
+
+    for _ in range(n_warmup):
+        backward(forward())
+    synchronize(device)
+    forward_durations, backward_durations = [], []
+    for _ in range(n_steps):
+        start = perf_counter()
+        outputs = forward()
+        synchronize(device)
+        middle = perf_counter()
+        backward(outputs)
+        synchronize(device)
+        forward_durations.append((middle - start) * 1e3)
+        backward_durations.append((perf_counter() - middle) * 1e3)
+    return stats(forward_durations), stats(backward_durations)
+
+
+def iw_expand(tensor, iw_samples):
+    # As in BayesNet.forward for IW losses. The copy makes it contiguous like the activations links usually get, which
+    # went through a layer after the expansion.
+    return tensor.unsqueeze(0).expand([iw_samples] + list(tensor.shape)).contiguous() if iw_samples > 1 else tensor
+
+
+def build_link(name, config, flags, device):
+    # Link outputting Gaussian parameters of size z_size, and the function computing its outputs on random inputs
+    batch_size, max_len, hidden, iw = config['batch_size'], config['max_len'], config['hidden_size'], \
+                                      config['iw_samples']
+    params = Gaussian.parameter_activations
+    x = iw_expand(torch.randn(batch_size, max_len, flags.input_size, device=device), iw)
+    if name == 'GRULink':
+        # Sequential link: one call per time-step, conditioned on the previous step's sample, as in _sequential_forward
+        link = GRULink(flags.input_size, hidden, flags.z_size, flags.depth, params).to(device)
+
+        def forward():
+            z_prev, outputs = None, []
+            for x_i in x.unbind(-2):
+                z_params = link(x_i, z_prev)
+                z_prev = z_params['loc']
+                outputs.extend(z_params.values())
+            return outputs
+        return link, forward
+    if name in ('CoattentiveTransformerLink', 'ConditionalCoattentiveTransformerLink'):
+        assert hidden % flags.n_targets == 0 and flags.z_size % flags.n_targets == 0
+        if name == 'CoattentiveTransformerLink':
+            link = CoattentiveTransformerLink(flags.input_size, hidden, flags.z_size, flags.depth, params,
+                                              n_targets=flags.n_targets, sequence=['x']).to(device)
+            inputs = {'x': x}
+        else:
+            # The memory is read from the first time-step of its inputs, split in n_mems vectors
+            link = ConditionalCoattentiveTransformerLink(flags.input_size, hidden, flags.z_size, flags.depth, params,
+                                                         n_mems=flags.n_targets, memory=['z'],
+                                                         targets=['x']).to(device)
+            inputs = {'x': x, 'z': iw_expand(torch.randn(batch_size, max_len, hidden, device=device), iw)}
+        return link, lambda: list(link(inputs).values())
+    link_class = {'MLPLink': MLPLink, 'LastStateMLPLink': LastStateMLPLink, 'LSTMLink': LSTMLink,
+                  'TransformerLink': TransformerLink}[name]
+    link = link_class(flags.input_size, hidden, flags.z_size, flags.depth, params).to(device)
+    return link, lambda: list(link(x).values())
+
+
+def build_variable(name, path, config, flags, device):
+    # Latent variable of size z_size, its link (an MLPLink for _forward and a GRULink for _sequential_forward, whose
+    # calls dispatch to these paths in BaseLatentVariable.forward), and the function computing its samples and
+    # log-probabilities on random inputs
+    batch_size, max_len, hidden, iw = config['batch_size'], config['max_len'], config['hidden_size'], \
+                                      config['iw_samples']
+    sequential = path == '_sequential_forward'
+    link_embedding = None
+    if name == 'Gaussian':
+        variable = Gaussian(flags.z_size, 'z', device)
+    elif name == 'Categorical':
+        embedding = nn.Embedding(flags.z_size, flags.embedding_dim)
+        variable = Categorical(flags.z_size, 'z', device, embedding, ignore=None)
+        # As in the generation network, the sequential link reads the previous word's embedding and outputs its
+        # logits through the embedding matrix
+        link_embedding = embedding if sequential else None
+    else:
+        assert flags.z_size % flags.n_disc == 0
+        # Embedding of the size of the variable, so that the sequential link can be conditioned on its representation
+        variable = MultiCategorical(flags.z_size, 'z', device, MultiEmbedding(flags.z_size, flags.n_disc, flags.z_size),
+                                    ignore=None, n_disc=flags.n_disc)
+    link_class = GRULink if sequential else MLPLink
+    link = link_class(flags.input_size, hidden, flags.z_size, flags.depth, variable.parameter_activations,
+                      embedding=link_embedding).to(device)
+    variable.to(device)
+    inputs = {'x': iw_expand(torch.randn(batch_size, max_len, flags.input_size, device=device), iw)}
+
+    def forward():
+        variable(link, inputs)
+        return [variable.post_reps, variable.post_log_probas]
+    return nn.ModuleList([link, variable]), forward
+
+
+def configurations(flags):
+    benchmarks = [('link', name, None) for name in flags.links] + \
+                 [('variable', name, path) for name, path in itertools.product(flags.variables, flags.paths)]
+    for (kind, name, path), batch_size, max_len, hidden_size, iw_samples in \
+            itertools.product(benchmarks, flags.batch_sizes, flags.max_lens, flags.hidden_sizes, flags.iw_samples):
+        yield {'kind': kind, 'name': name, 'path': path, 'batch_size': batch_size, 'max_len': max_len,
+               'hidden_size': hidden_size, 'iw_samples': iw_samples}
+
+
+def benchmark(config, flags, device):
+    if config['kind'] == 'link':
+        module, forward = build_link(config['name'], config, flags, device)
+    else:
+        module, forward = build_variable(config['name'], config['path'], config, flags, device)
+    module.train()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    result = dict(config)
+    result['forward'], result['backward'] = time_forward_backward(forward, flags.warmup, flags.steps, device)
+    tokens = config['batch_size'] * config['max_len'] * config['iw_samples']
+    result['tokens_per_s'] = tokens / ((result['forward']['mean_ms'] + result['backward']['mean_ms']) / 1e3)
+    result['saved_activations_mb'] = saved_activations_mb(forward)
+    result['peak_memory_mb'] = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else None
+    result['parameters'] = sum(p.numel() for p in module.parameters() if p.requires_grad)
+    return result
+
+
+def result_key(result):
+    return tuple(result[k] for k in ['kind', 'name', 'path', 'batch_size', 'max_len', 'hidden_size', 'iw_samples'])
+
+
+def regressions(results, baseline, tolerance):
+    # Benchmarks whose forward or backward time exceeds the baseline's by more than the tolerance, or that fail while
+    # they ran in the baseline. The minimum over the timed calls is compared, being the least sensitive to noise from
+    # other processes. Timings are only comparable on the same device, which is checked by the caller.
+    baseline_results = {result_key(r): r for r in baseline['results'] if 'error' not in r}
+    slower = []
+    for result in results:
+        reference = baseline_results.get(result_key(result))
+        if reference is None:
+            continue
+        if 'error' in result:
+            slower.append((result_key(result), 'error', reference['forward']['min_ms'], float('nan'), float('inf')))
+            continue
+        for phase in ('forward', 'backward'):
+            ratio = result[phase]['min_ms'] / max(reference[phase]['min_ms'], 1e-6)
+            if ratio > 1 + tolerance:
+                slower.append((result_key(result), phase, reference[phase]['min_ms'], result[phase]['min_ms'], ratio))
+    return slower
+
+
+def main():
+    flags = parser.parse_args()
+    device = torch.device(flags.device)
+    report = {'commit': git_commit(), 'date': strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__,
+              'python': platform.python_version(), 'device': str(device),
+              'device_name': torch.cuda.get_device_name(device) if device.type == 'cuda' else platform.processor(),
+              'threads': torch.get_num_threads(), 'flags': vars(flags), 'results': []}
+    for config in configurations(flags):
+        # A failing configuration is reported and the others still run
+        try:
+            result = benchmark(config, flags, device)
+            print("{name} {path} bs={batch_size} len={max_len} h={hidden_size} iw={iw_samples}: ".format(**config) +
+                  "forward {:.2f} ms, backward {:.2f} ms, {:.0f} tokens/s".format(
+                      result['forward']['mean_ms'], result['backward']['mean_ms'], result['tokens_per_s']))
+        except Exception:
+            result = dict(config, error=traceback.format_exc(limit=3))
+            print("Failed: ", config)
+            traceback.print_exc()
+        report['results'].append(result)
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+    with open(flags.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to ", flags.output)
+
+    if flags.baseline is not None:
+        with open(flags.baseline) as f:
+            baseline = json.load(f)
+        if (baseline['device_name'], baseline['device']) != (report['device_name'], report['device']):
+            print("Warning: the baseline was measured on {} ({}), timings may not be comparable".format(
+                baseline['device'], baseline['device_name']))
+        slower = regressions(report['results'], baseline, flags.tolerance)
+        for key, phase, reference_ms, ms, ratio in slower:
+            print("Regression: {} {}: {:.2f} ms -> {:.2f} ms (x{:.2f})".format(key, phase, reference_ms, ms, ratio))
+        if slower:
+            sys.exit(1)
+        print("No regression beyond {:.0%} against {}".format(flags.tolerance, flags.baseline))
+
+
+if __name__ == '__main__':
+    main()
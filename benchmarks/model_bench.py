@@ -0,0 +1,154 @@
+# Times the model's training step (opt_step on an unsupervised and a supervised batch), its evaluation forward pass,
+# get_perplexity and get_overall_accuracy on synthetic data, for every combination of the given loss types, batch
+# sizes, max lengths and IW sample counts (the latter only for IW losses), and writes the results as JSON.
+# Examples:
+#   python -m benchmarks.model_bench --device cpu --losses S SSVAE --batch_sizes 8 --max_lens 32 --output bench.json
+#   python -m benchmarks.model_bench --device cuda:0 --graph postag --output bench_gpu.json
+import argparse
+import itertools
+import json
+import platform
+import shutil
+import subprocess
+import traceback
+from time import perf_counter, strftime
+
+import torch
+
+from benchmarks.synthetic import vocabularies, zipf_batches, build_model, IW_LOSSES
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--device", default='cpu', type=str)
+parser.add_argument("--graph", default='sentiment', choices=['sentiment', 'postag'], type=str)
+parser.add_argument("--losses", default=['S', 'SSVAE', 'SSIWAE', 'SSPIWO', 'SSiPIWO'], nargs='*', type=str)
+parser.add_argument("--batch_sizes", default=[8, 32], nargs='*', type=int)
+parser.add_argument("--max_lens", default=[64, 256], nargs='*', type=int)
+parser.add_argument("--iw_samples", default=[5], nargs='*', type=int)
+parser.add_argument("--vocab_size", default=20000, type=int)
+parser.add_argument("--n_tags", default=2, type=int)
+parser.add_argument("--steps", default=10, type=int)  # timed calls of each benchmark
+parser.add_argument("--warmup", default=2, type=int)  # untimed calls before
+parser.add_argument("--eval_batches", default=4, type=int)  # batches of the get_perplexity/get_overall_accuracy pass
+parser.add_argument("--embedding_dim", default=300, type=int)
+parser.add_argument("--pos_embedding_dim", default=50, type=int)
+parser.add_argument("--z_size", default=100, type=int)
+parser.add_argument("--text_rep_h", default=200, type=int)
+parser.add_argument("--encoder_h", default=200, type=int)
+parser.add_argument("--encoder_l", default=2, type=int)
+parser.add_argument("--pos_h", default=50, type=int)
+parser.add_argument("--pos_l", default=2, type=int)
+parser.add_argument("--decoder_h", default=200, type=int)
+parser.add_argument("--decoder_l", default=1, type=int)
+parser.add_argument("--output", default='model_bench.json', type=str)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_calls(function, n_warmup, n_steps, device):
+    # Milliseconds per call
+    for _ in range(n_warmup):
+        function()
+    synchronize(device)
+    durations = []
+    for _ in range(n_steps):
+        start = perf_counter()
+        function()
+        synchronize(device)
+        durations.append((perf_counter() - start) * 1e3)
+    return {'mean_ms': sum(durations) / len(durations), 'min_ms': min(durations), 'max_ms': max(durations)}
+
+
+def configurations(flags):
+    for losses, batch_size, max_len in itertools.product(flags.losses, flags.batch_sizes, flags.max_lens):
+        for iw_samples in (flags.iw_samples if losses in IW_LOSSES else flags.iw_samples[:1]):
+            yield {'losses': losses, 'batch_size': batch_size, 'max_len': max_len, 'training_iw_samples': iw_samples}
+
+
+def benchmark(config, flags, device):
+    vocab, tags = vocabularies(flags.vocab_size, flags.n_tags)
+    dims = {name: getattr(flags, name) for name in ['embedding_dim', 'pos_embedding_dim', 'z_size', 'text_rep_h',
+                                                    'encoder_h', 'encoder_l', 'pos_h', 'pos_l', 'decoder_h',
+                                                    'decoder_l']}
+    model = build_model(vocab, tags, flags.graph, config['losses'], config['batch_size'], config['max_len'],
+                        config['training_iw_samples'], device, tied_embeddings=False, **dims)
+    batches = zipf_batches(vocab, tags, max(2, flags.eval_batches), config['batch_size'], config['max_len'],
+                           flags.graph == 'postag', device)
+    batch = batches[0]
+    unsupervised = {'x': batch.text[..., 1:], 'x_prev': batch.text[..., :-1]}
+    supervised = {**unsupervised, 'y': batch.label}
+    tokens = int((batch.text != vocab.stoi['<pad>']).sum())
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    def train_step():
+        if config['losses'] != 'S':
+            model.opt_step(unsupervised)
+        model.opt_step(supervised)
+
+    def eval_forward():
+        # As in get_overall_accuracy
+        with torch.no_grad():
+            model(supervised, eval=True, gen_this=False)
+
+    result = dict(config)
+    model.train()
+    result['opt_step'] = time_calls(train_step, flags.warmup, flags.steps, device)
+    result['opt_step']['tokens_per_s'] = tokens * (1 + (config['losses'] != 'S')) / \
+        (result['opt_step']['mean_ms'] / 1e3)
+    model.eval()
+    result['forward_eval'] = time_calls(eval_forward, flags.warmup, flags.steps, device)
+    result['forward_eval']['tokens_per_s'] = tokens / (result['forward_eval']['mean_ms'] / 1e3)
+    eval_batches = batches[:flags.eval_batches]
+    eval_tokens = sum(int((b.text != vocab.stoi['<pad>']).sum()) for b in eval_batches)
+    evaluations = [('get_overall_accuracy', lambda: model.get_overall_accuracy(eval_batches))]
+    if config['losses'] != 'S':
+        # Purely supervised models have no generation network
+        evaluations.append(('get_perplexity', lambda: model.get_perplexity(eval_batches)))
+    for name, function in evaluations:
+        result[name] = time_calls(function, min(1, flags.warmup), max(1, flags.steps // 5), device)
+        result[name]['tokens_per_s'] = eval_tokens / (result[name]['mean_ms'] / 1e3)
+    result['parameters'] = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    result['peak_memory_mb'] = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else None
+    model.writer.close()
+    shutil.rmtree(model.h_params.viz_path, ignore_errors=True)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    flags = parser.parse_args()
+    device = torch.device(flags.device)
+    report = {'commit': git_commit(), 'date': strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__,
+              'python': platform.python_version(), 'device': str(device),
+              'device_name': torch.cuda.get_device_name(device) if device.type == 'cuda' else platform.processor(),
+              'threads': torch.get_num_threads(), 'flags': vars(flags), 'results': []}
+    for config in configurations(flags):
+        print("Benchmarking ", config)
+        # A failing configuration is reported and the others still run
+        try:
+            result = benchmark(config, flags, device)
+            print("opt_step: {:.2f} ms, forward_eval: {:.2f} ms".format(result['opt_step']['mean_ms'],
+                                                                      result['forward_eval']['mean_ms']))
+        except Exception:
+            result = dict(config, error=traceback.format_exc(limit=3))
+            print("Failed: ", config)
+            traceback.print_exc()
+        report['results'].append(result)
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+    with open(flags.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to ", flags.output)
+
+
+if __name__ == '__main__':
+    main()
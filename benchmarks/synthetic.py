@@ -0,0 +1,83 @@
+# Synthetic vocabularies, batches and models for the benchmarks. Token streams follow a Zipf law over the vocabulary,
+# like natural text, and sentence lengths are drawn between max_len/2 and max_len so that batches have padding.
+import tempfile
+
+import numpy as np
+import torch
+from torch import optim
+
+from sentence_classification.models import SSSentenceClassification as Model
+from sentence_classification.h_params import DefaultSSSentenceClassificationHParams as HParams
+from sentence_classification.graphs import get_sentiment_graph, get_postag_graph
+from components.criteria import Supervision, ELBo, IWLBo
+
+SPECIALS = ['<unk>', '<pad>', '<go>']
+GRAPHS = {'sentiment': get_sentiment_graph, 'postag': get_postag_graph}
+# Same loss settings as sent_train.py
+LOSSES = {'S': [Supervision], 'SSVAE': [Supervision, ELBo], 'SSPIWO': [Supervision, IWLBo],
+          'SSiPIWO': [Supervision, IWLBo], 'SSIWAE': [Supervision, IWLBo]}
+IW_LOSSES = ('SSPIWO', 'SSiPIWO', 'SSIWAE')
+
+
+class SyntheticVocab:
+    # The parts of torchtext's Vocab used by the model
+    def __init__(self, itos):
+        self.itos = itos
+        self.stoi = {w: i for i, w in enumerate(itos)}
+        self.freqs = {w: 1 for w in itos}
+
+
+class SyntheticBatch:
+    def __init__(self, text, label):
+        self.text = text
+        self.label = label
+
+
+def vocabularies(vocab_size, n_tags):
+    vocab = SyntheticVocab(SPECIALS + ['w{}'.format(i) for i in range(vocab_size - len(SPECIALS))])
+    tags = SyntheticVocab(['<pad>'] + ['t{}'.format(i) for i in range(n_tags)])
+    return vocab, tags
+
+
+def zipf_batches(vocab, tags, n_batches, batch_size, max_len, token_labels, device, seed=0, exponent=1.1):
+    # Batches as the data iterators make them: <go> + tokens padded to max_len, and per token labels (sentence labels
+    # are repeated along the sequence)
+    random_state = np.random.RandomState(seed)
+    n_words = len(vocab.itos) - len(SPECIALS)
+    probas = 1. / np.arange(1, n_words + 1) ** exponent
+    probas /= probas.sum()
+    pad, go, tag_pad = vocab.stoi['<pad>'], vocab.stoi['<go>'], tags.stoi['<pad>']
+    batches = []
+    for _ in range(n_batches):
+        lengths = random_state.randint(max(1, max_len // 2), max_len, size=batch_size)
+        text = np.full((batch_size, max_len), pad, dtype=np.int64)
+        label = np.full((batch_size, max_len - 1), tag_pad, dtype=np.int64)
+        text[:, 0] = go
+        sentence_labels = random_state.randint(1, len(tags.itos), size=batch_size)
+        for i, length in enumerate(lengths):
+            text[i, 1:length + 1] = random_state.choice(n_words, size=length, p=probas) + len(SPECIALS)
+            label[i, :length] = random_state.randint(1, len(tags.itos), size=length) if token_labels \
+                else sentence_labels[i]
+        if not token_labels:
+            label[:] = sentence_labels[:, None]
+        batches.append(SyntheticBatch(torch.from_numpy(text).to(device), torch.from_numpy(label).to(device)))
+    return batches
+
+
+def build_model(vocab, tags, graph, losses, batch_size, max_len, training_iw_samples, device, **dims):
+    # A model set up like sent_train.py does, logging to a temporary folder and without checkpoint loading
+    h_params = HParams(len(vocab.itos), len(tags.itos), max_len, batch_size, 1, device=device,
+                       pos_ignore_index=tags.stoi['<pad>'], vocab_ignore_index=vocab.stoi['<pad>'],
+                       test_name='benchmark', grad_accumulation_steps=1,
+                       optimizer_kwargs={'lr': 4e-3, 'weight_decay': 0., 'betas': (0.9, 0.99)}, highway=False,
+                       dropout=0.5, word_dropout=0.0, kl_th=0., text_rep_l=2,
+                       is_weighted=[], graph_generator=GRAPHS[graph], anneal_kl=[0, 0] if losses == 'S' else [0, 10],
+                       losses=LOSSES[losses], loss_params=[1] if 'SS' not in losses else [1, 1],
+                       training_iw_samples=training_iw_samples, testing_iw_samples=training_iw_samples,
+                       piwo=losses == 'SSPIWO', ipiwo=losses == 'SSiPIWO', optimizer=optim.AdamW, markovian=True,
+                       contiguous_lm=False, **dims)
+    h_params.viz_path = tempfile.mkdtemp(prefix='benchmark_tb_')
+    model = Model(vocab, tags, h_params, autoload=False)
+    if device.type == 'cuda':
+        model.cuda(device)
+    return model
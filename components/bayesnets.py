@@ -9,6 +9,7 @@ from components.latent_variables import BaseLatentVariable, Categorical, Gaussia
 from components.links import BaseLink
 
 from time import time
+import json
 
 class BayesNet(nn.Module):
     def __init__(self, vertices):
@@ -53,6 +54,10 @@ class BayesNet(nn.Module):
         else:
             self.dp_lvl = {lv: 0 for lv in self.variables}
 
+        # Objects with before_vertex(net, lv, dp_lvl) and after_vertex(net, lv, dp_lvl) methods, called around the
+        # computation of each vertex in forward (see VertexProfiler)
+        self.vertex_hooks = []
+
     def _get_max_iw_path(self, lv, lvl, force_lv=None):
         if (lv.iw and force_lv is None) or (force_lv and lv.name in force_lv):
             lvl += 1
@@ -73,6 +78,10 @@ class BayesNet(nn.Module):
         # The forward pass propagates the root variable values yielding
         if prev_states is None:
             prev_states = {v: None for v in self.variables}
+        # Links that continue their sequences from one call to the next (see LSTMLink.carry_state)
+        carried_links = set(l for l in self.approximator.values() if getattr(l, 'carry_state', False))
+        for link in carried_links:
+            link.prev_state = prev_states.get(link)
 
         # Getting current duplication levels
         if force_iw:
@@ -148,8 +157,12 @@ class BayesNet(nn.Module):
                             this_len = lens
                     else:
                         this_len = lens
+                    for hook in self.vertex_hooks:
+                        hook.before_vertex(self, lv, max_cond_lvl)
                     lv(self.approximator[lv], lv_conditions, gt_samples=gt_lv, complete=(lv in self.child) or complete,
                        lens=this_len)
+                    for hook in self.vertex_hooks:
+                        hook.after_vertex(self, lv, max_cond_lvl)
                     if eval:
                         if isinstance(lv, Categorical):
                             self.variables_hat[lv] = torch.nn.functional.one_hot(torch.argmax(lv.post_params['logits'],
@@ -167,8 +180,12 @@ class BayesNet(nn.Module):
             assert all([lv in self.variables_hat or lv in self.variables_star for lv in self.variables])
             assert all([lv in self.log_proba or (lv in self.input_variables and not lv.allow_prior)
                         for lv in self.variables])
-        new_prev_state = {v: tuple(v_i.detach() for v_i in v.prev_state) if v.prev_state is not None else None
+        # Recurrent states are detached for truncated back-propagation through time (LSTM states are (h, c) tuples)
+        new_prev_state = {v: (v.prev_state.detach() if torch.is_tensor(v.prev_state)
+                              else tuple(v_i.detach() for v_i in v.prev_state)) if v.prev_state is not None else None
                           for v in self.variables}
+        for link in carried_links:
+            new_prev_state[link], link.prev_state = link.prev_state, None
         return new_prev_state
 
     def _ready_condition(self, lv, n_iw, max_lvl, prev_states, dp_lvl, force_iw, eval):
@@ -193,3 +210,82 @@ class BayesNet(nn.Module):
             inputs[lv.name] = lv.prior_sample(sample_shape)[0]
 
         self(inputs)
+
+
+class VertexProfiler:
+    # Records, for each vertex (parents, link, child) computed in the forward passes of the attached BayesNets: its
+    # wall time, the memory it allocated (on GPUs), the shapes of its outputs and its IW duplication level. The device
+    # is synchronized around each vertex so that times can be attributed, which slows the forward passes down: only
+    # attach it for profiling. Results are exported with table() and chrome_trace().
+    def __init__(self, max_events=100000):
+        self.nets = {}
+        self.events = []
+        self.max_events = max_events
+        self.stats = {}
+        self.start = None
+        self.origin = time()
+
+    def attach(self, name, net):
+        self.nets[net] = name
+        net.vertex_hooks.append(self)
+
+    def detach(self):
+        for net in self.nets:
+            net.vertex_hooks.remove(self)
+        self.nets = {}
+
+    def _sync(self, link):
+        parameter = next(link.parameters(), None)
+        if parameter is not None and parameter.device.type == 'cuda':
+            torch.cuda.synchronize(parameter.device)
+            return parameter.device
+        return None
+
+    def before_vertex(self, net, lv, dp_lvl):
+        device = self._sync(net.approximator[lv])
+        self.start = (time(), torch.cuda.memory_allocated(device) if device is not None else 0)
+
+    def after_vertex(self, net, lv, dp_lvl):
+        link = net.approximator[lv]
+        device = self._sync(link)
+        end, memory = time(), torch.cuda.memory_allocated(device) if device is not None else 0
+        key = (self.nets.get(net, ''), ', '.join(p.name for p in net.parent[lv]), type(link).__name__, lv.name)
+        shapes = {name: list(value.shape) for name, value in (lv.post_params or {}).items() if torch.is_tensor(value)}
+        if torch.is_tensor(lv.post_samples):
+            shapes['samples'] = list(lv.post_samples.shape)
+        duration, allocated = end - self.start[0], memory - self.start[1]
+        stat = self.stats.setdefault(key, {'calls': 0, 'time': 0., 'allocated': 0, 'shapes': None, 'dp_lvl': dp_lvl,
+                                           'link': link})
+        stat['calls'] += 1
+        stat['time'] += duration
+        stat['allocated'] += allocated
+        stat['shapes'], stat['dp_lvl'] = shapes, dp_lvl
+        if len(self.events) < self.max_events:
+            self.events.append({'name': '{} -> {}'.format(key[1], key[3]), 'cat': key[2], 'ph': 'X',
+                                'ts': (self.start[0] - self.origin) * 1e6, 'dur': duration * 1e6, 'pid': 0,
+                                'tid': key[0], 'args': {'link': key[2], 'dp_lvl': dp_lvl, 'allocated_bytes': allocated,
+                                                        'shapes': shapes}})
+
+    def table(self):
+        # One line per vertex, by decreasing total time. The last column lists the other vertices whose links share
+        # parameters with this one (e.g. a common LSTM), since their costs are intertwined.
+        total = sum(stat['time'] for stat in self.stats.values()) or 1.
+        params = {key: {id(p) for p in stat['link'].parameters()} for key, stat in self.stats.items()}
+        row = '{:<10} {:<24} {:<20} {:<6} {:>6} {:>10} {:>9} {:>6} {:>12} {:>6} {:<60} {}'
+        lines = [row.format(
+            'net', 'parents', 'link', 'child', 'calls', 'total_ms', 'mean_ms', 'share', 'alloc_MB', 'dp_lvl',
+            'shapes', 'shares_params_with')]
+        for key, stat in sorted(self.stats.items(), key=lambda item: -item[1]['time']):
+            shared = ['{}:{}'.format(other[0], other[3]) for other in self.stats
+                      if other != key and params[key] & params[other]]
+            lines.append(row.format(key[0], key[1], key[2], key[3], stat['calls'], '{:.2f}'.format(stat['time'] * 1e3),
+                                    '{:.3f}'.format(stat['time'] * 1e3 / stat['calls']),
+                                    '{:.1%}'.format(stat['time'] / total),
+                                    '{:.2f}'.format(stat['allocated'] / stat['calls'] / 2**20), stat['dp_lvl'],
+                                    str(stat['shapes']), ', '.join(shared)))
+        return '\n'.join(lines)
+
+    def chrome_trace(self, path):
+        # Complete ("X") events, one thread per attached net, to be opened in chrome://tracing or Perfetto
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
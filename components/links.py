@@ -177,6 +177,10 @@ class LSTMLink(BaseLink):
                            dropout=dropout)
         self.last_state = last_state
         self.bidirectional = bidirectional
+        # With carry_state, the (h, c) state the LSTM starts from, replaced by the (detached) state it reaches. It is
+        # set and collected by BayesNet.forward through its prev_states, to continue sequences across batches.
+        self.carry_state = False
+        self.prev_state = None
 
         self.drp_layer = torch.nn.Dropout(p=dropout)
         self.bn = nn.BatchNorm1d(z_size)
@@ -212,7 +216,11 @@ class LSTMLink(BaseLink):
             lens = torch.ones(x.shape[1], device=device) * x.shape[0]
         packed_x = nn.utils.rnn.pack_padded_sequence(x, lens, enforce_sorted=False)
 
-        packed_outputs, (hidden, cell) = self.rnn(packed_x)
+        hx = self.prev_state if self.carry_state and self.prev_state is not None and \
+            self.prev_state[0].shape[1] == x.shape[1] else None
+        packed_outputs, (hidden, cell) = self.rnn(packed_x, hx)
+        if self.carry_state:
+            self.prev_state = (hidden.detach(), cell.detach())
 
         if self.last_state:
             outputs = torch.cat([hidden[-1, :, :], hidden[-2, :, :]] if self.bidirectional else
@@ -580,7 +588,7 @@ class SpecialTransformerEncoder(TransformerEncoderLayer):
                                  nn.Embedding(n_mems, int(d_model/2)).weight
         self.linear0 = torch.nn.Linear(d_model, int(d_model/2))
 
-    def forward(self, src, src_mask=None, src_key_padding_mask=None):
+    def forward(self, src, src_mask=None, src_key_padding_mask=None, is_causal=False):
         r"""Pass the input through the encoder layer.
 
         Args:
@@ -591,6 +599,7 @@ class SpecialTransformerEncoder(TransformerEncoderLayer):
         Shape:
             see the docs in Transformer class.
         """
+        # is_causal is passed by TransformerEncoder since torch 2.0, only src_mask is used here
         q = self.q.unsqueeze(1).expand(self.q.shape[0], src.shape[1], self.q.shape[1])
         k = self.k.unsqueeze(1).expand(self.k.shape[0], src.shape[1], self.k.shape[1])
         v = self.v.unsqueeze(1).expand(self.v.shape[0], src.shape[1], self.v.shape[1])
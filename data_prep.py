@@ -1,7 +1,18 @@
 # This file is destined to wrap all the data pipelining utilities (reading, tokenizing, padding, batchifying .. )
 import io
 import os
-
+import json
+import hashlib
+import math
+import shutil
+import tempfile
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import fcntl
+import collections
+from collections import Counter
+
+import torch
 import torchtext.data as data
 from torchtext.data import Dataset, Example
 import torchtext.datasets as datasets
@@ -19,74 +30,55 @@ VOCAB_LIMIT = 10000
 
 class HuggingIMDB2:
     def __init__(self, max_len, batch_size, max_epochs, device, unsup_proportion, sup_proportion, dev_index=1,
-                 pretrained=False):
-        text_field = data.Field(lower=True, batch_first=True, fix_length=max_len, pad_token='<pad>',
-                                init_token='<go>'
-                                ,
-                                is_target=True)  # init_token='<go>', eos_token='<eos>', unk_token='<unk>', pad_token='<unk>')
-        label_field = data.Field(fix_length=max_len - 1, batch_first=True, unk_token=None)
+                 pretrained=False, bucketing=False, max_tokens=None, shared=False):
         start = time()
-        train_data, test_data, unsup_data = load_dataset('imdb')['train'], load_dataset('imdb')['test'],\
-                                            load_dataset('imdb')['unsupervised']
-
-        def expand_labels(datum):
-            datum['label'] = [str(datum['label'])]*(max_len-1)
-            return datum
-
-        train_data, test_data = train_data.map(expand_labels), test_data.map(expand_labels)
-        fields1 = {'text': text_field, 'label': label_field}
-        fields2 = {'text': ('text', text_field), 'label': ('label', label_field)}
-        fields3 = {'text': text_field}
-        fields4 = {'text': ('text', text_field)}
-        dev_start, dev_end = int(len(train_data)/5*(dev_index-1)), \
-                             int(len(train_data)/5*(dev_index))
-        train_start1, train_start2, train_end1, train_end2 = 0, dev_end, int(dev_start*sup_proportion),\
-                                                             int(dev_end+(len(train_data)-dev_end)*sup_proportion)
-        unsup_start, unsup_end = 0, int(len(unsup_data)*unsup_proportion)
-        # Since the datasets are originally sorted with the label as key, we shuffle them before reducing the supervised
-        # or the unsupervised data to the first few examples. We use a fixed see to keep the same data for all
-        # experiments
-        np.random.seed(42)
-        train_examples = [Example.fromdict(ex, fields2) for ex in train_data]
-        unsup_examples = ([Example.fromdict(ex, fields4) for ex in unsup_data])
-        np.random.shuffle(train_examples)
-        np.random.shuffle(unsup_examples)
-        train = Dataset(train_examples[train_start1:train_end1]+train_examples[train_start2:train_end2], fields1)
-        val = Dataset(train_examples[dev_start:dev_end], fields1)
-        test = Dataset([Example.fromdict(ex, fields2) for ex in test_data], fields1)
-        unsup_train = Dataset(unsup_examples[unsup_start:unsup_end]
-                              , fields3)
-        vocab_dataset = Dataset(train_examples, fields1)
-
-        unsup_test, unsup_val = test, test
+        cache = TokenCache('imdb', max_len)
+        if not cache.exists():
+            train_data, test_data, unsup_data = load_dataset('imdb')['train'], load_dataset('imdb')['test'],\
+                                                load_dataset('imdb')['unsupervised']
+            # Since the datasets are originally sorted with the label as key, we shuffle them before reducing the
+            # supervised or the unsupervised data to the first few examples. We use a fixed see to keep the same data
+            # for all experiments
+            train_order, unsup_order = shuffled_orders(cache.seed, len(train_data), len(unsup_data))
+            cache.write({'train': (arrow_column(train_data, 'text'), arrow_column(train_data, 'label')),
+                         'test': (arrow_column(test_data, 'text'), arrow_column(test_data, 'label')),
+                         'unsup': (arrow_column(unsup_data, 'text'), None)}, 'train',
+                        orders={'train': train_order, 'unsup': unsup_order})
+        splits, vocab, meta = cache.load(shared=shared)
+        # The experiment's splits are index views over the cache, computed once per fold and proportions
+        def make_views():
+            train_examples = splits['train'].subset(meta['orders']['train'])
+            unsup_examples = splits['unsup'].subset(meta['orders']['unsup'])
+
+            dev_start, dev_end = int(len(train_examples)/5*(dev_index-1)), \
+                                 int(len(train_examples)/5*(dev_index))
+            train_start1, train_start2, train_end1, train_end2 = \
+                0, dev_end, int(dev_start*sup_proportion), int(dev_end+(len(train_examples)-dev_end)*sup_proportion)
+            unsup_start, unsup_end = 0, int(len(unsup_examples)*unsup_proportion)
+            return {'train': train_examples.subset(np.r_[train_start1:train_end1, train_start2:train_end2]),
+                    'val': train_examples.subset(np.arange(dev_start, dev_end)),
+                    'unsup_train': unsup_examples.subset(np.arange(unsup_start, unsup_end))}
+        views = cache.split_views(splits, split_key(dev_index, sup_proportion, unsup_proportion), make_views)
+        train, val, unsup_train = views['train'], views['val'], views['unsup_train']
+        test = splits['test']
+        unsup_val = test
 
         print('data loading took', time() - start)
 
-        # build the vocabulary
-        text_field.build_vocab(vocab_dataset, max_size=VOCAB_LIMIT) #, vectors="fasttext.simple.300d")
-        label_field.build_vocab(train)
+        # build the label vocabulary
+        self.vocab = vocab
+        self.tags = build_tag_vocab(train, meta['label_itos'], ['<pad>'], extra_splits=(val, test))
         # make iterator for splits
-        self.train_iter, _, _ = data.BucketIterator.splits(
-            (unsup_train, unsup_val, unsup_test), batch_size=batch_size, device=device, shuffle=True, sort=False)
-        _, self.unsup_val_iter, _ = data.BucketIterator.splits(
-            (unsup_train, unsup_val, unsup_test), batch_size=int(batch_size), device=device, shuffle=False,
-            sort=False)
-        self.sup_iter, _, _ = data.BucketIterator.splits(
-            (train, val, test), batch_size=batch_size, device=device, shuffle=True, sort=False)
-        _, self.val_iter, self.test_iter = data.BucketIterator.splits(
-            (train, val, test), batch_size=int(batch_size), device=device, shuffle=False, sort=False)
+        self.train_iter, self.unsup_val_iter, self.sup_iter, self.val_iter, self.test_iter = cached_iterators(
+            train, val, test, unsup_train, unsup_val, self.vocab, self.tags, batch_size, device, max_len,
+            bucketing=bucketing, max_tokens=max_tokens)
 
-        self.vocab = text_field.vocab
-        self.tags = label_field.vocab
-        self.text_field = text_field
-        self.label_field = label_field
         self.device = device
         self.batch_size = batch_size
         self.n_epochs = 0
         self.max_epochs = max_epochs
         if pretrained:
-            ftxt = FastText()
-            self.wvs = ftxt.get_vecs_by_tokens(self.vocab.itos)
+            self.wvs = cached_word_vectors(self.vocab.itos)
         else:
             self.wvs = None
 
@@ -112,78 +104,57 @@ class HuggingIMDB2:
 
 class HuggingAGNews:
     def __init__(self, max_len, batch_size, max_epochs, device, unsup_proportion, sup_proportion, dev_index=1,
-                 pretrained=False):
-        text_field = data.Field(lower=True, batch_first=True, fix_length=max_len, pad_token='<pad>',
-                                init_token='<go>'
-                                ,
-                                is_target=True)  # init_token='<go>', eos_token='<eos>', unk_token='<unk>', pad_token='<unk>')
-        label_field = data.Field(fix_length=max_len - 1, batch_first=True, unk_token=None)
-
+                 pretrained=False, bucketing=False, max_tokens=None, shared=False):
         start = time()
-        train_data, test_data = load_dataset('ag_news')['train'], load_dataset('ag_news')['test']
-
-        def expand_labels(datum):
-            datum['label'] = [str(datum['label'])]*(max_len-1)
-            return datum
-        # lens = [len(sample['text'].split(' ')) for sample in train_data]
-        # print(np.quantile(lens, [0.5, 0.7, 0.9, 0.95, 0.99]))
-
-        train_data, test_data = train_data.map(expand_labels), test_data.map(expand_labels)
-        fields1 = {'text': text_field, 'label': label_field}
-        fields2 = {'text': ('text', text_field), 'label': ('label', label_field)}
-        fields3 = {'text': text_field}
-        fields4 = {'text': ('text', text_field)}
-        len_train = 32000
-        dev_start, dev_end = int(len_train/5*(dev_index-1)), \
-                             int(len_train/5*(dev_index))
-        train_start1, train_start2, train_end1, train_end2 = 0, dev_end, int(dev_start*sup_proportion),\
-                                                             int(dev_end+(len_train-dev_end)*sup_proportion)
-        unsup_start, unsup_end = len_train, int(len_train+64000*unsup_proportion)
-
-        # Since the datasets are originally sorted with the label as key, we shuffle them before reducing the supervised
-        # or the unsupervised data to the first few examples. We use a fixed see to keep the same data for all
-        # experiments
-        np.random.seed(42)
-        train_examples = [Example.fromdict(ex, fields2) for ex in train_data]
-        unsup_examples = ([Example.fromdict(ex, fields4) for ex in train_data])
-        np.random.shuffle(train_examples)
-        np.random.shuffle(unsup_examples)
-        train = Dataset(train_examples[train_start1:train_end1]+train_examples[train_start2:train_end2], fields1)
-        val = Dataset(train_examples[dev_start:dev_end], fields1)
-        test = Dataset([Example.fromdict(ex, fields2) for ex in test_data], fields1)
-        unsup_train = Dataset(unsup_examples[unsup_start:unsup_end]
-                              , fields3)
-        vocab_dataset = Dataset(train_examples, fields1)
-
-        unsup_test, unsup_val = test, test
+        cache = TokenCache('ag_news', max_len)
+        if not cache.exists():
+            train_data, test_data = load_dataset('ag_news')['train'], load_dataset('ag_news')['test']
+            # lens = [len(sample['text'].split(' ')) for sample in train_data]
+            # print(np.quantile(lens, [0.5, 0.7, 0.9, 0.95, 0.99]))
+
+            # Since the datasets are originally sorted with the label as key, we shuffle them before reducing the
+            # supervised or the unsupervised data to the first few examples. We use a fixed see to keep the same data
+            # for all experiments
+            train_order, unsup_order = shuffled_orders(cache.seed, len(train_data), len(train_data))
+            cache.write({'train': (arrow_column(train_data, 'text'), arrow_column(train_data, 'label')),
+                         'test': (arrow_column(test_data, 'text'), arrow_column(test_data, 'label'))}, 'train',
+                        orders={'train': train_order, 'unsup': unsup_order})
+        splits, vocab, meta = cache.load(shared=shared)
+        # The experiment's splits are index views over the cache, computed once per fold and proportions
+        def make_views():
+            train_examples = splits['train'].subset(meta['orders']['train'])
+            unsup_examples = splits['train'].subset(meta['orders']['unsup'])
+
+            len_train = 32000
+            dev_start, dev_end = int(len_train/5*(dev_index-1)), \
+                                 int(len_train/5*(dev_index))
+            train_start1, train_start2, train_end1, train_end2 = 0, dev_end, int(dev_start*sup_proportion),\
+                                                                 int(dev_end+(len_train-dev_end)*sup_proportion)
+            unsup_start, unsup_end = len_train, int(len_train+64000*unsup_proportion)
+            return {'train': train_examples.subset(np.r_[train_start1:train_end1, train_start2:train_end2]),
+                    'val': train_examples.subset(np.arange(dev_start, dev_end)),
+                    'unsup_train': unsup_examples.subset(np.arange(unsup_start, unsup_end))}
+        views = cache.split_views(splits, split_key(dev_index, sup_proportion, unsup_proportion), make_views)
+        train, val, unsup_train = views['train'], views['val'], views['unsup_train']
+        test = splits['test']
+        unsup_val = test
 
         print('data loading took', time() - start)
 
-        # build the vocabulary
-        text_field.build_vocab(vocab_dataset, max_size=VOCAB_LIMIT)  # , vectors="fasttext.simple.300d")
-        label_field.build_vocab(train)
+        # build the label vocabulary
+        self.vocab = vocab
+        self.tags = build_tag_vocab(train, meta['label_itos'], ['<pad>'], extra_splits=(val, test))
         # make iterator for splits
-        self.train_iter, _, _ = data.BucketIterator.splits(
-            (unsup_train, unsup_val, unsup_test), batch_size=batch_size, device=device, shuffle=True, sort=False)
-        _, self.unsup_val_iter, _ = data.BucketIterator.splits(
-            (unsup_train, unsup_val, unsup_test), batch_size=int(batch_size), device=device, shuffle=False,
-            sort=False)
-        self.sup_iter, _, _ = data.BucketIterator.splits(
-            (train, val, test), batch_size=batch_size, device=device, shuffle=True, sort=False)
-        _, self.val_iter, self.test_iter = data.BucketIterator.splits(
-            (train, val, test), batch_size=int(batch_size), device=device, shuffle=False, sort=False)
+        self.train_iter, self.unsup_val_iter, self.sup_iter, self.val_iter, self.test_iter = cached_iterators(
+            train, val, test, unsup_train, unsup_val, self.vocab, self.tags, batch_size, device, max_len,
+            bucketing=bucketing, max_tokens=max_tokens)
 
-        self.vocab = text_field.vocab
-        self.tags = label_field.vocab
-        self.text_field = text_field
-        self.label_field = label_field
         self.device = device
         self.batch_size = batch_size
         self.n_epochs = 0
         self.max_epochs = max_epochs
         if pretrained:
-            ftxt = FastText()
-            self.wvs = ftxt.get_vecs_by_tokens(self.vocab.itos)
+            self.wvs = cached_word_vectors(self.vocab.itos)
         else:
             self.wvs = None
 
@@ -210,81 +181,59 @@ class HuggingAGNews:
 class HuggingYelp:
 
     def __init__(self, max_len, batch_size, max_epochs, device, unsup_proportion, sup_proportion, dev_index=1,
-                 pretrained=False):
-        text_field = data.Field(lower=True, batch_first=True, fix_length=max_len, pad_token='<pad>',
-                                init_token='<go>'
-                                ,
-                                is_target=True)  # init_token='<go>', eos_token='<eos>', unk_token='<unk>', pad_token='<unk>')
-        label_field = data.Field(fix_length=max_len - 1, batch_first=True, unk_token=None)
-
-        print('Current working directory:', os.getcwd())
-        yelp_data = load_dataset('csv', data_files={'train': os.path.join('.data', 'yelp', 'train.csv'),
-                                                                'test': os.path.join('.data', 'yelp', 'test.csv')},
-                                             column_names=['label', 'text'], version='0.0.2')
-                                             #download_mode=FORCE_REDOWNLOAD)
-
+                 pretrained=False, bucketing=False, max_tokens=None, shared=False):
         start = time()
-        train_data, test_data = yelp_data['train'], yelp_data['test']
-        def expand_labels(datum):
-            datum['label'] = [str(datum['label'])]*(max_len-1)
-            return datum
-        lens = [len(sample['text'].split(' ')) for sample in train_data]
-
-        train_data, test_data = train_data.map(expand_labels), test_data.map(expand_labels)
-        fields1 = {'text': text_field, 'label': label_field}
-        fields2 = {'text': ('text', text_field), 'label': ('label', label_field)}
-        fields3 = {'text': text_field}
-        fields4 = {'text': ('text', text_field)}
-
-        len_train = int(len(train_data)/3)
-        dev_start, dev_end = int(len_train/5*(dev_index-1)), \
-                             int(len_train/5*(dev_index))
-        train_start1, train_start2, train_end1, train_end2 = 0, dev_end, int(dev_start*sup_proportion),\
-                                                             int(dev_end+(len_train-dev_end)*sup_proportion)
-        unsup_start, unsup_end = len_train, int(len_train+len_train*2*unsup_proportion)
-        # Since the datasets are originally sorted with the label as key, we shuffle them before reducing the supervised
-        # or the unsupervised data to the first few examples. We use a fixed see to keep the same data for all
-        # experiments
-        np.random.seed(42)
-        train_examples = [Example.fromdict(ex, fields2) for ex in train_data]
-        unsup_examples = [Example.fromdict(ex, fields4) for ex in train_data]
-        np.random.shuffle(train_examples)
-        np.random.shuffle(unsup_examples)
-        train = Dataset(train_examples[train_start1:train_end1]+train_examples[train_start2:train_end2], fields1)
-        val = Dataset(train_examples[dev_start:dev_end], fields1)
-        test = Dataset([Example.fromdict(ex, fields2) for ex in test_data], fields1)
-        unsup_train = Dataset(unsup_examples[unsup_start:unsup_end], fields3)
-
-        vocab_dataset = Dataset(train_examples, fields1)
-        unsup_test, unsup_val = test, test
+        cache = TokenCache('yelp', max_len)
+        if not cache.exists():
+            print('Current working directory:', os.getcwd())
+            yelp_data = load_dataset('csv', data_files={'train': os.path.join('.data', 'yelp', 'train.csv'),
+                                                        'test': os.path.join('.data', 'yelp', 'test.csv')},
+                                     column_names=['label', 'text'], version='0.0.2')
+                                     #download_mode=FORCE_REDOWNLOAD)
+            train_data, test_data = yelp_data['train'], yelp_data['test']
+            # Since the datasets are originally sorted with the label as key, we shuffle them before reducing the
+            # supervised or the unsupervised data to the first few examples. We use a fixed see to keep the same data
+            # for all experiments
+            train_order, unsup_order = shuffled_orders(cache.seed, len(train_data), len(train_data))
+            cache.write({'train': (arrow_column(train_data, 'text'), arrow_column(train_data, 'label')),
+                         'test': (arrow_column(test_data, 'text'), arrow_column(test_data, 'label'))}, 'train',
+                        orders={'train': train_order, 'unsup': unsup_order})
+        splits, vocab, meta = cache.load(shared=shared)
+        # The experiment's splits are index views over the cache, computed once per fold and proportions
+        def make_views():
+            train_examples = splits['train'].subset(meta['orders']['train'])
+            unsup_examples = splits['train'].subset(meta['orders']['unsup'])
+
+            len_train = int(len(train_examples)/3)
+            dev_start, dev_end = int(len_train/5*(dev_index-1)), \
+                                 int(len_train/5*(dev_index))
+            train_start1, train_start2, train_end1, train_end2 = 0, dev_end, int(dev_start*sup_proportion),\
+                                                                 int(dev_end+(len_train-dev_end)*sup_proportion)
+            unsup_start, unsup_end = len_train, int(len_train+len_train*2*unsup_proportion)
+            return {'train': train_examples.subset(np.r_[train_start1:train_end1, train_start2:train_end2]),
+                    'val': train_examples.subset(np.arange(dev_start, dev_end)),
+                    'unsup_train': unsup_examples.subset(np.arange(unsup_start, unsup_end))}
+        views = cache.split_views(splits, split_key(dev_index, sup_proportion, unsup_proportion), make_views)
+        train, val, unsup_train = views['train'], views['val'], views['unsup_train']
+        test = splits['test']
+        unsup_val = test
 
         print('data loading took', time() - start)
 
-        # build the vocabulary
-        text_field.build_vocab(vocab_dataset, max_size=VOCAB_LIMIT)  # , vectors="fasttext.simple.300d")
-        label_field.build_vocab(train)
+        # build the label vocabulary
+        self.vocab = vocab
+        self.tags = build_tag_vocab(train, meta['label_itos'], ['<pad>'], extra_splits=(val, test))
         # make iterator for splits
-        self.train_iter, _, _ = data.BucketIterator.splits(
-            (unsup_train, unsup_val, unsup_test), batch_size=batch_size, device=device, shuffle=True, sort=False)
-        _, self.unsup_val_iter, _ = data.BucketIterator.splits(
-            (unsup_train, unsup_val, unsup_test), batch_size=int(batch_size), device=device, shuffle=False,
-            sort=False)
-        self.sup_iter, _, _ = data.BucketIterator.splits(
-            (train, val, test), batch_size=batch_size, device=device, shuffle=True, sort=False)
-        _, self.val_iter, self.test_iter = data.BucketIterator.splits(
-            (train, val, test), batch_size=int(batch_size), device=device, shuffle=False, sort=False)
+        self.train_iter, self.unsup_val_iter, self.sup_iter, self.val_iter, self.test_iter = cached_iterators(
+            train, val, test, unsup_train, unsup_val, self.vocab, self.tags, batch_size, device, max_len,
+            bucketing=bucketing, max_tokens=max_tokens)
 
-        self.vocab = text_field.vocab
-        self.tags = label_field.vocab
-        self.text_field = text_field
-        self.label_field = label_field
         self.device = device
         self.batch_size = batch_size
         self.n_epochs = 0
         self.max_epochs = max_epochs
         if pretrained:
-            ftxt = FastText()
-            self.wvs = ftxt.get_vecs_by_tokens(self.vocab.itos)
+            self.wvs = cached_word_vectors(self.vocab.itos)
         else:
             self.wvs = None
 
@@ -367,22 +316,28 @@ class IMDBData:
 
 class UDPoSDaTA:
     def __init__(self, max_len, batch_size, max_epochs, device, unsup_proportion, sup_proportion, dev_index=1,
-                 pretrained=False):
-        text_field = data.Field(lower=True, batch_first=True,  fix_length=max_len, pad_token='<pad>', init_token='<go>'
-                                , is_target=True)#init_token='<go>', eos_token='<eos>', unk_token='<unk>', pad_token='<unk>')
-        label_field = data.Field(fix_length=max_len-1, batch_first=True)
-
-        # make splits for data
-        #unsup_train, unsup_val, unsup_test = MyPennTreebank.splits(text_field)
-        #unsup_train, unsup_val, unsup_test = datasets.PennTreebank.splits(text_field)
-        #unsup_train, unsup_val, unsup_test = datasets.WikiText2.splits(text_field)
-        unsup_train, unsup_val, unsup_test = datasets.UDPOS.splits((('text', text_field), ('label', label_field)))
-        #unsup_train, unsup_val, unsup_test = YahooLM.splits(text_field)
-        train, val, test = datasets.UDPOS.splits((('text', text_field), ('label', label_field)))
-
-        # build the vocabulary
-        text_field.build_vocab(unsup_train, max_size=VOCAB_LIMIT)  # , vectors="fasttext.simple.300d")
-        label_field.build_vocab(train)
+                 pretrained=False, bucketing=False, max_tokens=None, shared=False):
+        cache = TokenCache('ud', max_len)
+        if not cache.exists():
+            text_field = data.Field(lower=True)
+            label_field = data.Field()
+
+            # make splits for data
+            #unsup_train, unsup_val, unsup_test = MyPennTreebank.splits(text_field)
+            #unsup_train, unsup_val, unsup_test = datasets.PennTreebank.splits(text_field)
+            #unsup_train, unsup_val, unsup_test = datasets.WikiText2.splits(text_field)
+            #unsup_train, unsup_val, unsup_test = YahooLM.splits(text_field)
+            train, val, test = datasets.UDPOS.splits((('text', text_field), ('label', label_field)))
+            # The labelled pool is the concatenation of the train and validation examples. Its first n_train examples
+            # (the original train split) also serve as unsupervised training data and vocabulary source.
+            exlist = [ex for ex in train] + [ex for ex in val]
+            cache.write({'labelled': ([ex.text for ex in exlist], [ex.label for ex in exlist]),
+                         'test': ([ex.text for ex in test], [ex.label for ex in test])},
+                        'labelled', vocab_examples=len(train), extra={'n_train': len(train), 'n_valid': len(val)})
+        splits, vocab, meta = cache.load(shared=shared)
+        n_train, n_valid = meta['extra']['n_train'], meta['extra']['n_valid']
+        unsup_train = splits['labelled'].subset(np.arange(n_train))
+        unsup_val = splits['labelled'].subset(np.arange(n_train, n_train + n_valid))
         # self.train_iter, _,  _ = data.BPTTIterator.splits((unsup_train, unsup_val, unsup_test),
         #                                                                     batch_size=batch_size, bptt_len=max_len,
         #                                                                     device=device, repeat=False, shuffle=False,
@@ -391,41 +346,37 @@ class UDPoSDaTA:
         #                                                                     batch_size=int(batch_size/10), bptt_len=max_len,
         #                                                                     device=device, repeat=False, shuffle=False,
         #                                                                     sort=False)
-        # Remaking splits according to supervision proportions
-        exlist = [ex for ex in train+val]
-        train =Dataset(exlist, {'text': text_field, 'label': label_field})
-        dev_start, dev_end = int(len(train) / 5 * (dev_index - 1)), \
-                             int(len(train) / 5 * (dev_index))
-        train_start1, train_start2, train_end1, train_end2 = 0, dev_end, int(dev_start * sup_proportion), \
-                                                             int(dev_end + (len(train) - dev_end) * sup_proportion)
-        unsup_start, unsup_end = 0, int(len(unsup_train) * unsup_proportion)
-        val = Dataset(train[dev_start:dev_end], {'text': text_field, 'label': label_field})
-        train = Dataset(train[train_start1:train_end1] + train[train_start2:train_end2],
-                        {'text': text_field, 'label': label_field})
-        unsup_train = Dataset(unsup_train[unsup_start:unsup_end], {'text': text_field})
-
+        # Remaking splits according to supervision proportions (index views computed once per fold and proportions)
+        def make_views():
+            train = splits['labelled']
+            dev_start, dev_end = int(len(train) / 5 * (dev_index - 1)), \
+                                 int(len(train) / 5 * (dev_index))
+            train_start1, train_start2, train_end1, train_end2 = 0, dev_end, int(dev_start * sup_proportion), \
+                                                                 int(dev_end + (len(train) - dev_end) * sup_proportion)
+            unsup_start, unsup_end = 0, int(len(unsup_train) * unsup_proportion)
+            return {'train': train.subset(np.r_[train_start1:train_end1, train_start2:train_end2]),
+                    'val': train.subset(np.arange(dev_start, dev_end)),
+                    'unsup_train': unsup_train.subset(np.arange(unsup_start, unsup_end))}
+        views = cache.split_views(splits, split_key(dev_index, sup_proportion, unsup_proportion), make_views)
+        train, val, unsup_train = views['train'], views['val'], views['unsup_train']
+        test = splits['test']
+
+        # build the label vocabulary
+        self.vocab = vocab
+        self.tags = build_tag_vocab(splits['labelled'].subset(np.arange(n_train)), meta['label_itos'],
+                                    ['<unk>', '<pad>'])
         # make iterator for splits
+        self.train_iter, self.unsup_val_iter, self.sup_iter, self.val_iter, self.test_iter = cached_iterators(
+            train, val, test, unsup_train, unsup_val, self.vocab, self.tags, batch_size, device, max_len,
+            unsup_val_batch_size=max(1, int(batch_size/10)), sup_shuffle=False, bucketing=bucketing,
+            max_tokens=max_tokens)
 
-        self.train_iter, _,  _ = data.BucketIterator.splits(
-            (unsup_train, unsup_val, unsup_test), batch_size=batch_size, device=device, shuffle=True, sort=False)
-        _, self.unsup_val_iter,  _ = data.BucketIterator.splits(
-            (unsup_train, unsup_val, unsup_test), batch_size=int(batch_size/10), device=device, shuffle=False, sort=False)
-        self.sup_iter, _, _ = data.BucketIterator.splits(
-            (train, val, test), batch_size=batch_size, device=device, shuffle=False, sort=False)
-        _, self.val_iter, self.test_iter = data.BucketIterator.splits(
-            (train, val, test), batch_size=int(batch_size), device=device, shuffle=False, sort=False)
-
-        self.vocab = text_field.vocab
-        self.tags = label_field.vocab
-        self.text_field = text_field
-        self.label_field = label_field
         self.device = device
         self.batch_size = batch_size
         self.n_epochs = 0
         self.max_epochs = max_epochs
         if pretrained:
-            ftxt = FastText()
-            self.wvs = ftxt.get_vecs_by_tokens(self.vocab.itos)
+            self.wvs = cached_word_vectors(self.vocab.itos)
         else:
             self.wvs = None
 
@@ -482,8 +433,7 @@ class NLIGenData2:
         self.n_epochs = 0
         self.max_epochs = max_epochs
         if pretrained:
-            ftxt = FastText()
-            self.wvs = ftxt.get_vecs_by_tokens(self.vocab.itos)
+            self.wvs = cached_word_vectors(self.vocab.itos)
         else:
             self.wvs = None
 
@@ -508,22 +458,160 @@ class NLIGenData2:
 
 
 class Wiki2Data:
-    def __init__(self, max_len, batch_size, max_epochs, device):
+    def __init__(self, max_len, batch_size, max_epochs, device, streaming=False, shard_size=100000,
+                 contiguous_lm=False):
+        assert not (streaming and contiguous_lm), "Packed streams are built in memory, they can't be streamed"
         text_field = data.Field(lower=True, batch_first=True, fix_length=max_len, init_token='<go>',
                                 eos_token='<eos>',)
 
-        # make splits for data
-        train, val, test = MyWikiText2.splits(text_field)
+        if streaming:
+            # The corpus is read, numericalized and batched shard by shard at each pass instead of being held in memory
+            train, val, test = MyWikiText2.splits(text_field, streaming=True, shard_size=shard_size)
+            text_field.vocab = train.build_vocab()
+            self.train_iter, self.val_iter, self.test_iter = [
+                StreamingIterator(split, batch_size, device, False, max_len, text_field.vocab)
+                for split in (train, val, test)]
+        else:
+            # make splits for data
+            train, val, test = MyWikiText2.splits(text_field)
 
-        # build the vocabulary
-        text_field.build_vocab(train)  # , vectors="fasttext.simple.300d")
+            # build the vocabulary
+            text_field.build_vocab(train)  # , vectors="fasttext.simple.300d")
+
+            # make iterator for splits
+            if contiguous_lm:
+                # Sentences are packed in max_len windows without padding, to be used with h_params.contiguous_lm
+                self.train_iter, self.val_iter, self.test_iter = packed_lm_iterators(
+                    (train, val, test), text_field.vocab, batch_size, max_len, device)
+            else:
+                self.train_iter, self.val_iter,  self.test_iter = data.BucketIterator.splits(
+                    (train, val, test), batch_size=batch_size, device=device, shuffle=False, sort=False)
+                self.val_iter.shuffle = False
+                self.test_iter.shuffle = False
+
+        self.contiguous_lm = contiguous_lm
+        self.vocab = text_field.vocab
+        self.tags = None
+        self.text_field = text_field
+        self.label_field = None
+        self.device = device
+        self.batch_size = batch_size
+        self.n_epochs = 0
+        self.max_epochs = max_epochs
+        self.wvs = None
+
+    def reinit_iterator(self, split):
+        if split == 'train':
+            self.n_epochs += 1
+            print("Finished epoch n°{}".format(self.n_epochs))
+            if self.n_epochs < self.max_epochs:
+                self.train_iter.init_epoch()
+            else:
+                print("Reached n_epochs={} and finished training !".format(self.n_epochs))
+                self.train_iter = None
+
+        elif split == 'valid':
+            self.val_iter.init_epoch()
+        elif split == 'test':
+            self.test_iter.init_epoch()
+        else:
+            raise NameError('Misspelled split name : {}'.format(split))
 
-        # make iterator for splits
-        self.train_iter, self.val_iter,  self.test_iter = data.BucketIterator.splits(
-            (train, val, test), batch_size=batch_size, device=device, shuffle=False, sort=False)
-        self.val_iter.shuffle = False
-        self.test_iter.shuffle = False
 
+class PTBData:
+    def __init__(self, max_len, batch_size, max_epochs, device, streaming=False, shard_size=100000,
+                 contiguous_lm=False):
+        assert not (streaming and contiguous_lm), "Packed streams are built in memory, they can't be streamed"
+        text_field = data.Field(lower=True, batch_first=True, fix_length=max_len, init_token='<go>',
+                                eos_token='<eos>',)
+
+        if streaming:
+            # The corpus is read, numericalized and batched shard by shard at each pass instead of being held in memory
+            train, val, test = MyPennTreebank.splits(text_field, streaming=True, shard_size=shard_size)
+            text_field.vocab = train.build_vocab()
+            self.train_iter, self.val_iter, self.test_iter = [
+                StreamingIterator(split, batch_size, device, False, max_len, text_field.vocab)
+                for split in (train, val, test)]
+        else:
+            # make splits for data
+            train, val, test = MyPennTreebank.splits(text_field)
+
+            # build the vocabulary
+            text_field.build_vocab(train)  # , vectors="fasttext.simple.300d")
+
+            # make iterator for splits
+            if contiguous_lm:
+                # Sentences are packed in max_len windows without padding, to be used with h_params.contiguous_lm
+                self.train_iter, self.val_iter, self.test_iter = packed_lm_iterators(
+                    (train, val, test), text_field.vocab, batch_size, max_len, device)
+            else:
+                self.train_iter, self.val_iter,  self.test_iter = data.BucketIterator.splits(
+                    (train, val, test), batch_size=batch_size, device=device, shuffle=False, sort=False)
+                self.val_iter.shuffle = False
+                self.test_iter.shuffle = False
+
+        self.contiguous_lm = contiguous_lm
+        self.vocab = text_field.vocab
+        self.tags = None
+        self.text_field = text_field
+        self.label_field = None
+        self.device = device
+        self.batch_size = batch_size
+        self.n_epochs = 0
+        self.max_epochs = max_epochs
+        self.wvs = None
+
+    def reinit_iterator(self, split):
+        if split == 'train':
+            self.n_epochs += 1
+            print("Finished epoch n°{}".format(self.n_epochs))
+            if self.n_epochs < self.max_epochs:
+                self.train_iter.init_epoch()
+            else:
+                print("Reached n_epochs={} and finished training !".format(self.n_epochs))
+                self.train_iter = None
+
+        elif split == 'valid':
+            self.val_iter.init_epoch()
+        elif split == 'test':
+            self.test_iter.init_epoch()
+        else:
+            raise NameError('Misspelled split name : {}'.format(split))
+
+
+class YahooData:
+    def __init__(self, max_len, batch_size, max_epochs, device, streaming=False, shard_size=100000,
+                 contiguous_lm=False):
+        assert not (streaming and contiguous_lm), "Packed streams are built in memory, they can't be streamed"
+        text_field = data.Field(lower=True, batch_first=True, fix_length=max_len, init_token='<go>',
+                                eos_token='<eos>',)
+
+        if streaming:
+            # The corpus is read, numericalized and batched shard by shard at each pass instead of being held in memory
+            train, val, test = YahooLM.splits(text_field, streaming=True, shard_size=shard_size)
+            text_field.vocab = train.build_vocab()
+            self.train_iter, self.val_iter, self.test_iter = [
+                StreamingIterator(split, batch_size, device, False, max_len, text_field.vocab)
+                for split in (train, val, test)]
+        else:
+            # make splits for data
+            train, val, test = YahooLM.splits(text_field)
+
+            # build the vocabulary
+            text_field.build_vocab(train)  # , vectors="fasttext.simple.300d")
+
+            # make iterator for splits
+            if contiguous_lm:
+                # Sentences are packed in max_len windows without padding, to be used with h_params.contiguous_lm
+                self.train_iter, self.val_iter, self.test_iter = packed_lm_iterators(
+                    (train, val, test), text_field.vocab, batch_size, max_len, device)
+            else:
+                self.train_iter, self.val_iter,  self.test_iter = data.BucketIterator.splits(
+                    (train, val, test), batch_size=batch_size, device=device, shuffle=False, sort=False)
+                self.val_iter.shuffle = False
+                self.test_iter.shuffle = False
+
+        self.contiguous_lm = contiguous_lm
         self.vocab = text_field.vocab
         self.tags = None
         self.text_field = text_field
@@ -553,21 +641,29 @@ class Wiki2Data:
 
 
 class NLIGenData:
-    def __init__(self, max_len, batch_size, max_epochs, device):
+    def __init__(self, max_len, batch_size, max_epochs, device, streaming=False, shard_size=100000):
         text_field = data.Field(lower=True, batch_first=True, fix_length=max_len, init_token='<go>',
                                 eos_token='<eos>',)
 
-        # make splits for data
-        train, val, test = NLIGen.splits(text_field)
+        if streaming:
+            # The corpus is read, numericalized and batched shard by shard at each pass instead of being held in memory
+            train, val, test = NLIGen.splits(text_field, streaming=True, shard_size=shard_size)
+            text_field.vocab = train.build_vocab()
+            self.train_iter, self.val_iter, self.test_iter = [
+                StreamingIterator(split, batch_size, device, False, max_len, text_field.vocab)
+                for split in (train, val, test)]
+        else:
+            # make splits for data
+            train, val, test = NLIGen.splits(text_field)
 
-        # build the vocabulary
-        text_field.build_vocab(train)  # , vectors="fasttext.simple.300d")
+            # build the vocabulary
+            text_field.build_vocab(train)  # , vectors="fasttext.simple.300d")
 
-        # make iterator for splits
-        self.train_iter, self.val_iter,  self.test_iter = data.BucketIterator.splits(
-            (train, val, test), batch_size=batch_size, device=device, shuffle=False, sort=False)
-        self.val_iter.shuffle = False
-        self.test_iter.shuffle = False
+            # make iterator for splits
+            self.train_iter, self.val_iter,  self.test_iter = data.BucketIterator.splits(
+                (train, val, test), batch_size=batch_size, device=device, shuffle=False, sort=False)
+            self.val_iter.shuffle = False
+            self.test_iter.shuffle = False
 
         self.vocab = text_field.vocab
         self.tags = None
@@ -605,6 +701,651 @@ class MyVocab:
         self.stoi = stoi
 
 
+# ------------------------------------------------ Token cache ---------------------------------------------------------
+# Numericalized splits are written once to TOKEN_CACHE_ROOT and re-opened with np.memmap by later runs, so that sweeps
+# don't reload, re-tokenize and re-shuffle the raw datasets for every experiment.
+TOKEN_CACHE_ROOT = os.path.join('.data', 'token_cache')
+TOKEN_DTYPE = np.uint16
+VECTOR_CACHE_ROOT = os.path.join('.data', 'vector_cache')
+
+
+def cached_word_vectors(itos, language='en', root=VECTOR_CACHE_ROOT):
+    # Rows of the FastText vectors for the words in itos. They are extracted once, saved as a small .npy file keyed by a
+    # hash of the vocabulary and of the vector source, and memory-mapped by later runs (and the other dev folds).
+    source = 'fasttext.{}'.format(language)
+    key = hashlib.sha1('\n'.join([source] + list(itos)).encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(root, '{}_{}_{}.npy'.format(source, len(itos), key))
+    if not os.path.exists(path):
+        t0 = time()
+        wvs = FastText(language=language).get_vecs_by_tokens(itos).numpy().astype(np.float32)
+        os.makedirs(root, exist_ok=True)
+        tmp_path = '{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid())
+        np.save(tmp_path, wvs)
+        os.replace(tmp_path, path)
+        print('caching word vectors in {} took {}'.format(path, time() - t0))
+    return np.load(path, mmap_mode='r')
+
+
+def build_vocab(counter, specials, max_size=None):
+    # Reproduces torchtext's Vocab ordering: specials first, then tokens by decreasing frequency, ties broken
+    # alphabetically
+    words_and_frequencies = sorted([(w, c) for w, c in counter.items() if w not in specials], key=lambda tup: tup[0])
+    words_and_frequencies.sort(key=lambda tup: tup[1], reverse=True)
+    if max_size is not None:
+        words_and_frequencies = words_and_frequencies[:max_size]
+    itos = list(specials) + [w for w, _ in words_and_frequencies]
+    return MyVocab(itos, {w: i for i, w in enumerate(itos)})
+
+
+class CachedSplit:
+    # A split of a token cache: a flat token array with per-example offsets, and optional labels that are either one
+    # value per example (sentence classification) or one value per token (tagging, sharing the token offsets)
+    def __init__(self, tokens, offsets, labels=None, token_labels=False, indices=None):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.labels = labels
+        self.token_labels = token_labels
+        self.indices = np.arange(len(offsets) - 1) if indices is None else np.asarray(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        j = self.indices[i]
+        return self.tokens[self.offsets[j]:self.offsets[j+1]]
+
+    def subset(self, indices):
+        # Index views share the underlying (memory-mapped) arrays
+        return CachedSplit(self.tokens, self.offsets, self.labels, self.token_labels, self.indices[indices])
+
+    def lengths(self, idx=None):
+        rows = self.indices if idx is None else self.indices[idx]
+        return self.offsets[rows + 1] - self.offsets[rows]
+
+    def label_values(self):
+        # Every label value occurring in this split, in storage order (used to count tag frequencies)
+        if self.labels is None:
+            return np.zeros(0, dtype=np.int64)
+        if not self.token_labels:
+            return np.asarray(self.labels[self.indices])
+        return np.concatenate([self.labels[self.offsets[j]:self.offsets[j+1]] for j in self.indices]
+                              + [np.zeros(0, dtype=self.labels.dtype)])
+
+
+# Shared memory blocks attached by this process, they stay mapped as long as the process lives
+_SHARED_BLOCKS = {}
+_LOADED_CACHES = {}
+
+
+class TokenCache:
+    # Each cache directory is keyed by the dataset name, max_len, VOCAB_LIMIT and the shuffling seed, and holds a
+    # meta.json with the vocabularies plus one tokens/offsets(/labels) binary file per split.
+    def __init__(self, name, max_len, seed=42, root=TOKEN_CACHE_ROOT):
+        self.name = name
+        self.max_len = max_len
+        self.seed = seed
+        self.path = os.path.join(root, '{}_len{}_voc{}_seed{}'.format(name, max_len, VOCAB_LIMIT, seed))
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, 'meta.json'))
+
+    def write(self, splits, vocab_split, vocab_examples=None, orders=None, extra=None,
+              specials=('<unk>', '<pad>', '<go>'), lower=True, n_workers=None):
+        # splits maps each split name to a (texts, labels) couple, where texts are raw strings or token lists and
+        # labels are None, one label per example, or one label sequence per example. The vocabulary is counted on
+        # the full (non truncated) texts of the first vocab_examples examples of vocab_split, like
+        # Field.build_vocab does. orders holds the seeded shuffling permutations that are stored along the splits.
+        # Tokenization runs over whole columns in n_workers processes, and numericalization is a NumPy lookup.
+        start = time()
+        names = list(splits)
+        words, encoded = tokenize_columns([splits[name][0] for name in names], lower, n_workers=n_workers)
+        encoded = dict(zip(names, encoded))
+        vocab_ids, vocab_lens = encoded[vocab_split]
+        n_counted = int(vocab_lens[:vocab_examples].sum()) if vocab_examples is not None else len(vocab_ids)
+        counts = np.bincount(vocab_ids[:n_counted], minlength=len(words))
+        vocab = build_vocab(Counter({w: int(c) for w, c in zip(words, counts) if c}), specials, max_size=VOCAB_LIMIT)
+        assert len(vocab.itos) <= np.iinfo(TOKEN_DTYPE).max, "Vocabulary too large for {}".format(TOKEN_DTYPE)
+        # Lookup table from the tokenizer's word ids to vocabulary ids
+        unk = vocab.stoi['<unk>']
+        lookup = np.array([vocab.stoi.get(w, unk) for w in words], dtype=TOKEN_DTYPE)
+        label_itos = sorted({str(l) for _, labels in splits.values() if labels is not None
+                             for lab in labels for l in (lab if isinstance(lab, (list, tuple)) else [lab])})
+        label_stoi = {l: i for i, l in enumerate(label_itos)}
+        # Texts are truncated as Field(fix_length=max_len, init_token='<go>') would do it
+        truncate = self.max_len - 1
+
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(self.path) or '.', prefix='.tmp_')
+        meta = {'itos': vocab.itos, 'label_itos': label_itos, 'extra': extra or {}, 'splits': {}, 'orders': {}}
+        for name, order in (orders or {}).items():
+            np.asarray(order, dtype=np.int64).tofile(os.path.join(tmp_path, name + '.order.bin'))
+            meta['orders'][name] = len(order)
+        for name, (_, labels) in splits.items():
+            ids, lens = encoded[name]
+            kept = positions_in_sequences(lens) < truncate
+            offsets = np.zeros(len(lens) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(np.minimum(lens, truncate))
+            tokens = lookup[ids[kept]]
+            tokens.tofile(os.path.join(tmp_path, name + '.tokens.bin'))
+            offsets.tofile(os.path.join(tmp_path, name + '.offsets.bin'))
+            token_labels = labels is not None and len(labels) > 0 and isinstance(labels[0], (list, tuple))
+            if labels is not None:
+                if token_labels:
+                    label_ids = np.fromiter((label_stoi[str(l)] for lab in labels for l in lab), dtype=np.int16,
+                                            count=int(lens.sum()))[kept]
+                else:
+                    label_ids = np.array([label_stoi[str(l)] for l in labels], dtype=np.int16)
+                label_ids.tofile(os.path.join(tmp_path, name + '.labels.bin'))
+            meta['splits'][name] = {'n_examples': len(lens), 'n_tokens': int(offsets[-1]),
+                                    'has_labels': labels is not None, 'token_labels': token_labels}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            # Another process wrote the same cache concurrently
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        print('writing token cache {} took {}'.format(self.path, time() - start))
+
+    def load(self, shared=False):
+        # Returns ({split name: CachedSplit}, vocabulary, meta data). The stored permutations are returned in
+        # meta['orders'] and the raw label strings in meta['label_itos'].
+        # With shared, the arrays are read-only views on named shared memory blocks: the first process on the node
+        # copies the cache files in, and the others (e.g. concurrent runs on other folds) attach to the same blocks.
+        # The blocks outlive the processes until release_shared() is called.
+        # Loaded caches are kept for the process' lifetime, so that runs of a sweep don't re-open them
+        self.stamp = self._stamp()
+        if (self.path, self.stamp, shared) in _LOADED_CACHES:
+            return _LOADED_CACHES[(self.path, self.stamp, shared)]
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.shared = shared
+        splits = {}
+        for name, info in meta['splits'].items():
+            tokens = self._memmap(name + '.tokens.bin', TOKEN_DTYPE, info['n_tokens'])
+            offsets = self._memmap(name + '.offsets.bin', np.int64, info['n_examples'] + 1)
+            labels = None
+            if info['has_labels']:
+                labels = self._memmap(name + '.labels.bin', np.int16,
+                                      info['n_tokens'] if info['token_labels'] else info['n_examples'])
+            splits[name] = CachedSplit(tokens, offsets, labels, info['token_labels'])
+        meta['orders'] = {name: self._memmap(name + '.order.bin', np.int64, size)
+                          for name, size in meta['orders'].items()}
+        vocab = MyVocab(meta['itos'], {w: i for i, w in enumerate(meta['itos'])})
+        _LOADED_CACHES[(self.path, self.stamp, shared)] = splits, vocab, meta
+        return splits, vocab, meta
+
+    def split_views(self, splits, key, make_views):
+        # Index views over the loaded splits for one experiment configuration (see split_key). make_views returns
+        # {view name: subset of a split} and only runs the first time, after which the views' rows are read back from
+        # a small manifest (one .npy of row indices per view) and memory-mapped.
+        path = os.path.join(self.path, 'manifests', key)
+        if not os.path.exists(os.path.join(path, 'manifest.json')):
+            views = make_views()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp_')
+            manifest = {}
+            for name, view in views.items():
+                bases = [base for base, split in splits.items() if split.tokens is view.tokens]
+                assert len(bases) == 1, "View {} is not a subset of a single cached split".format(name)
+                np.save(os.path.join(tmp_path, name + '.npy'), np.asarray(view.indices, dtype=np.int64))
+                manifest[name] = bases[0]
+            with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another process wrote the same manifest concurrently
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        return {name: CachedSplit(splits[base].tokens, splits[base].offsets, splits[base].labels,
+                                  splits[base].token_labels, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+                for name, base in manifest.items()}
+
+    def _memmap(self, file_name, dtype, size):
+        if size == 0:
+            return np.zeros(0, dtype=dtype)
+        if self.shared:
+            return self._shared_array(file_name, dtype, size)
+        return np.memmap(os.path.join(self.path, file_name), dtype=dtype, mode='r', shape=(size,))
+
+    def _stamp(self):
+        # Identifies this build of the cache: a deleted and rebuilt cache folder gets a new meta.json
+        meta_stat = os.stat(os.path.join(self.path, 'meta.json'))
+        return '{}_{}'.format(meta_stat.st_ino, meta_stat.st_mtime_ns)
+
+    def _block_name(self, file_name, dtype, size):
+        # Blocks are named after the file, the cache build and the array size, so that a rebuilt cache never attaches
+        # to the stale blocks of a previous build
+        key = '{}:{}:{}:{}'.format(os.path.join(os.path.abspath(self.path), file_name), self.stamp,
+                                   np.dtype(dtype).str, size)
+        return 'ssvae_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:24]
+
+    def _shared_array(self, file_name, dtype, size):
+        block_name = self._block_name(file_name, dtype, size)
+        if block_name not in _SHARED_BLOCKS:
+            # The cache's meta.json is locked during block creation, so that no process attaches to a half copied block
+            with open(os.path.join(self.path, 'meta.json')) as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    block = shared_memory.SharedMemory(block_name)
+                except FileNotFoundError:
+                    block = shared_memory.SharedMemory(block_name, create=True, size=size * np.dtype(dtype).itemsize)
+                    np.ndarray((size,), dtype=dtype, buffer=block.buf)[:] = \
+                        np.fromfile(os.path.join(self.path, file_name), dtype=dtype, count=size)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            # Otherwise the block would be unlinked when this process exits
+            resource_tracker.unregister(block._name, 'shared_memory')
+            if block.size < size * np.dtype(dtype).itemsize:
+                block.close()
+                raise ValueError("Shared memory block {} of {} holds {} bytes instead of {}".format(
+                    block_name, os.path.join(self.path, file_name), block.size, size * np.dtype(dtype).itemsize))
+            _SHARED_BLOCKS[block_name] = block
+        array = np.ndarray((size,), dtype=dtype, buffer=_SHARED_BLOCKS[block_name].buf)
+        array.flags.writeable = False
+        return array
+
+    def release_shared(self):
+        # Unlinks the shared memory blocks of this cache, processes attached to them keep their mapping. Only the
+        # blocks of the current build are found, so call it before deleting a cache that is about to be rebuilt.
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.stamp = self._stamp()
+        arrays = [(name + '.order.bin', np.int64, size) for name, size in meta['orders'].items()]
+        for name, info in meta['splits'].items():
+            arrays += [(name + '.tokens.bin', TOKEN_DTYPE, info['n_tokens']),
+                       (name + '.offsets.bin', np.int64, info['n_examples'] + 1)]
+            if info['has_labels']:
+                arrays.append((name + '.labels.bin', np.int16,
+                               info['n_tokens'] if info['token_labels'] else info['n_examples']))
+        for file_name, dtype, size in arrays:
+            try:
+                block = shared_memory.SharedMemory(self._block_name(file_name, dtype, size))
+            except FileNotFoundError:
+                continue
+            block.close()
+            block.unlink()
+
+
+def split_key(dev_index, sup_proportion, unsup_proportion):
+    return 'dev{}_sup{}_unsup{}'.format(dev_index, repr(float(sup_proportion)), repr(float(unsup_proportion)))
+
+
+def tokenize(text, lower=True):
+    # Field's default tokenization: whitespace splitting followed by lower-casing
+    tokens = text.rstrip('\n').split() if isinstance(text, str) else list(text)
+    return [t.lower() for t in tokens] if lower else tokens
+
+
+def _tokenize_chunk(args):
+    # Tokenizes a chunk of texts and encodes its tokens with chunk-local word ids (in order of first appearance)
+    texts, lower = args
+    local_ids = {}
+    ids, lens = [], np.zeros(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        tokens = tokenize(text, lower)
+        lens[i] = len(tokens)
+        ids.extend([local_ids.setdefault(t, len(local_ids)) for t in tokens])
+    return list(local_ids), np.array(ids, dtype=np.int64), lens
+
+
+def tokenize_columns(columns, lower=True, n_workers=None, chunk_size=5000):
+    # Tokenizes whole text columns at once. Returns the list of distinct words, and for each column a flat array of
+    # word ids with the per-example token counts. Chunks are tokenized in a process pool when there are enough of
+    # them, and merged into the global word ids with array lookups.
+    chunks = [(column[i:i+chunk_size], lower) for column in columns for i in range(0, len(column), chunk_size)]
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(n_workers, len(chunks))) as pool:
+            results = pool.map(_tokenize_chunk, chunks)
+    else:
+        results = [_tokenize_chunk(chunk) for chunk in chunks]
+    word_ids = {}
+    encoded_chunks = []
+    for local_words, ids, lens in results:
+        remap = np.array([word_ids.setdefault(w, len(word_ids)) for w in local_words], dtype=np.int64)
+        encoded_chunks.append((remap[ids] if len(ids) else ids, lens))
+    encoded = []
+    for column in columns:
+        n_chunks = int(math.ceil(len(column) / chunk_size))
+        column_chunks, encoded_chunks = encoded_chunks[:n_chunks], encoded_chunks[n_chunks:]
+        encoded.append((np.concatenate([ids for ids, _ in column_chunks] + [np.zeros(0, dtype=np.int64)]),
+                        np.concatenate([lens for _, lens in column_chunks] + [np.zeros(0, dtype=np.int64)])))
+    return list(word_ids), encoded
+
+
+def positions_in_sequences(lens):
+    # Position of each element of a flat concatenation of sequences inside its own sequence
+    lens = np.asarray(lens, dtype=np.int64)
+    return np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+
+
+def arrow_column(dataset, column):
+    # Reads a whole column of an nlp (Arrow backed) dataset at once instead of going through python rows
+    table = getattr(dataset, 'data', None)
+    if table is not None and hasattr(table, 'column'):
+        return table.column(column).to_pylist()
+    return dataset[column]
+
+
+def build_tag_vocab(split, label_itos, specials, extra_splits=()):
+    # Counts raw label values over a (supervised) split, like label_field.build_vocab(train). Values that only occur
+    # in the extra splits are appended so that validation and test batches can still be numericalized.
+    counter = Counter(label_itos[l] for l in split.label_values())
+    tags = build_vocab(counter, specials)
+    for extra in extra_splits:
+        for l in np.unique(extra.label_values()):
+            if label_itos[l] not in tags.stoi:
+                tags.stoi[label_itos[l]] = len(tags.itos)
+                tags.itos.append(label_itos[l])
+    # Lookup table from raw label ids to tag ids
+    tags.lookup = np.array([tags.stoi.get(l, tags.stoi.get('<unk>', 0)) for l in label_itos], dtype=np.int64)
+    return tags
+
+
+class CachedBatch:
+    def __init__(self, text, label=None):
+        self.text = text
+        # Sentence level labels come as a single column, they are broadcast (without copy) along the sequence
+        if label is not None and label.shape[-1] == 1 and text.shape[-1] > 2:
+            label = label.expand(-1, text.shape[-1] - 1)
+        self.label = label
+
+
+class CachedIterator:
+    # Batch iterator over a CachedSplit that mirrors BucketIterator(sort=False): batch_first, fixed length padding with
+    # a leading <go> token, and a new random order at each pass when shuffle is set.
+    # With bucketing, examples are sorted by length inside pools of pool_size batches, each batch is only padded to
+    # its longest example, and batches are either batch_size examples or as many examples as fit in max_tokens
+    # (padded) tokens. The batch order is then shuffled with the same seeded random state.
+    def __init__(self, dataset, batch_size, device, shuffle, max_len, vocab, tags=None, seed=42, bucketing=False,
+                 max_tokens=None, pool_size=100):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.max_len = max_len
+        self.go_idx, self.pad_idx = vocab.stoi['<go>'], vocab.stoi['<pad>']
+        self.tags = tags
+        self.random_state = np.random.RandomState(seed)
+        self.epoch = 0
+        self.bucketing = bucketing or max_tokens is not None
+        self.max_tokens = max_tokens
+        self.pool_size = pool_size
+        # Position in the current pass (batches served) and random state at its start, to resume a pass exactly
+        self.position, self.pass_state, self.resume_position = 0, None, 0
+        assert max_tokens is None or max_tokens >= max_len, "max_tokens must at least fit one max_len example"
+
+    def __len__(self):
+        if self.max_tokens is None:
+            return int(math.ceil(len(self.dataset) / self.batch_size))
+        # Token budgeted batches depend on the shuffling, this counts the batches of a length sorted pass
+        return len(self._split_batches(np.argsort(self._widths(), kind='stable')))
+
+    def init_epoch(self):
+        self.epoch += 1
+
+    def batch_indices(self):
+        order = self.random_state.permutation(len(self.dataset)) if self.shuffle else np.arange(len(self.dataset))
+        if not self.bucketing:
+            return [order[i:i+self.batch_size] for i in range(0, len(order), self.batch_size)]
+        widths = self._widths()
+        pool = self.pool_size * self.batch_size
+        batches = []
+        for i in range(0, len(order), pool):
+            pool_order = order[i:i+pool]
+            batches.extend(self._split_batches(pool_order[np.argsort(widths[pool_order], kind='stable')]))
+        if self.shuffle:
+            batches = [batches[i] for i in self.random_state.permutation(len(batches))]
+        return batches
+
+    def pass_batches(self):
+        # Batches of a new pass, without those already served before the pass was interrupted (see load_state_dict)
+        self.pass_state = self.random_state.get_state()
+        self.position, self.resume_position = self.resume_position, 0
+        return self.batch_indices()[self.position:]
+
+    def state_dict(self):
+        state = self.pass_state if self.pass_state is not None else self.random_state.get_state()
+        return {'epoch': self.epoch, 'position': self.position,
+                'random_state': (state[0], state[1].tolist()) + tuple(state[2:])}
+
+    def load_state_dict(self, state):
+        # The next pass replays the interrupted one from its start state and skips the batches it had served
+        self.epoch = state['epoch']
+        self.random_state.set_state(state['random_state'])
+        self.resume_position = state['position']
+
+    def __iter__(self):
+        for idx in self.pass_batches():
+            self.position += 1
+            yield self.make_batch(idx)
+        self.position, self.pass_state = 0, None
+
+    def make_batch(self, idx):
+        text, label = self.make_arrays(idx)
+        return CachedBatch(torch.from_numpy(text).to(self.device),
+                           torch.from_numpy(label).to(self.device) if label is not None else None)
+
+    def make_arrays(self, idx):
+        # Collates the examples at positions idx into padded numpy arrays (also used by the prefetching workers)
+        width = max(2, int(self._widths(idx).max())) if self.bucketing else self.max_len
+        text = self._pad(idx, self.dataset.tokens, width, self.pad_idx, self.go_idx)
+        label = None
+        if self.tags is not None and self.dataset.labels is not None:
+            if self.dataset.token_labels:
+                raw = self._pad(idx, self.dataset.labels, width - 1, -1)
+                label = np.where(raw < 0, self.tags.stoi['<pad>'], self.tags.lookup[np.maximum(raw, 0)])
+            else:
+                # One label per example, CachedBatch broadcasts it to the per token shape
+                label = self.tags.lookup[self.dataset.labels[self.dataset.indices[idx]]][:, None]
+        return text, label
+
+    def _widths(self, idx=None):
+        # Padded length of each example, <go> token included
+        return np.minimum(self.dataset.lengths(idx) + 1, self.max_len)
+
+    def _split_batches(self, sorted_idx):
+        if self.max_tokens is None:
+            return [sorted_idx[i:i+self.batch_size] for i in range(0, len(sorted_idx), self.batch_size)]
+        widths = np.maximum(self._widths(sorted_idx), 2)
+        batches, start = [], 0
+        for end in range(1, len(sorted_idx) + 1):
+            # Widths are increasing, so the last example sets the padded size of the batch
+            if (end - start) * widths[end - 1] > self.max_tokens:
+                batches.append(sorted_idx[start:end - 1])
+                start = end - 1
+        if start < len(sorted_idx):
+            batches.append(sorted_idx[start:])
+        return batches
+
+    def _pad(self, idx, values, width, pad, init=None):
+        rows = self.dataset.indices[idx]
+        starts = self.dataset.offsets[rows]
+        lens = np.minimum(self.dataset.offsets[rows + 1] - starts, width - (init is not None))
+        shift = 1 if init is not None else 0
+        out = np.full((len(rows), width), pad, dtype=np.int64)
+        if init is not None:
+            out[:, 0] = init
+        if lens.sum():
+            row_ids = np.repeat(np.arange(len(rows)), lens)
+            col_ids = positions_in_sequences(lens) + shift
+            out[row_ids, col_ids] = np.concatenate([values[s:s+l] for s, l in zip(starts, lens)])
+        return out
+
+
+# Iterators served by the prefetching workers. It is filled before the worker processes are forked, so that they
+# inherit the (memory-mapped) datasets instead of receiving pickled copies.
+_PREFETCH_SOURCES = []
+
+
+def _prefetch_arrays(args):
+    source_id, idx = args
+    return _PREFETCH_SOURCES[source_id].make_arrays(idx)
+
+
+class PrefetchIterator:
+    # Wraps a CachedIterator so that the next n_prefetch batches are collated by worker processes while the model
+    # trains. The batch order is drawn in the main process with the wrapped iterator's random state, so that
+    # shuffling is the same as without prefetching. On GPUs, batches go through reusable pinned host buffers and are
+    # copied to the device asynchronously. Other attributes (dataset, init_epoch, ...) are those of the wrapped
+    # iterator.
+    def __init__(self, iterator, source_id, pool, n_prefetch=4):
+        self.iterator = iterator
+        self.source_id = source_id
+        self.pool = pool
+        self.n_prefetch = n_prefetch
+        device = torch.device(iterator.device)
+        self.pin = device.type == 'cuda' and torch.cuda.is_available()
+        self.free_slots = []
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['iterator'], name)
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def __iter__(self):
+        batches = iter(self.iterator.pass_batches())
+        in_flight = collections.deque()
+        slots = []
+        try:
+            for idx in batches:
+                in_flight.append(self.pool.apply_async(_prefetch_arrays, ((self.source_id, idx),)))
+                if len(in_flight) >= self.n_prefetch:
+                    break
+            while in_flight:
+                text, label = in_flight.popleft().get()
+                idx = next(batches, None)
+                if idx is not None:
+                    in_flight.append(self.pool.apply_async(_prefetch_arrays, ((self.source_id, idx),)))
+                self.iterator.position += 1
+                if not self.pin:
+                    yield CachedBatch(torch.from_numpy(text).to(self.iterator.device),
+                                      torch.from_numpy(label).to(self.iterator.device) if label is not None else None)
+                    continue
+                # Round robin over pinned slots, a slot is only rewritten once its last copy to the device is over
+                if len(slots) < 2:
+                    slot = self.free_slots.pop() if self.free_slots else self._new_slot()
+                else:
+                    slot = slots.pop(0)
+                slot['event'].synchronize()
+                batch = CachedBatch(self._to_device(slot['text'], text),
+                                    self._to_device(slot['label'], label) if label is not None else None)
+                slot['event'].record()
+                slots.append(slot)
+                yield batch
+            self.iterator.position, self.iterator.pass_state = 0, None
+        finally:
+            self.free_slots.extend(slots)
+
+    def _new_slot(self):
+        size = self.iterator.max_tokens or self.iterator.batch_size * self.iterator.max_len
+        return {'text': torch.empty(size, dtype=torch.long).pin_memory(),
+                'label': torch.empty(size, dtype=torch.long).pin_memory(), 'event': torch.cuda.Event()}
+
+    def _to_device(self, buffer, array):
+        if array.size > buffer.numel():
+            buffer.set_(torch.empty(array.size, dtype=torch.long).pin_memory())
+        host = buffer[:array.size].view(array.shape)
+        host.copy_(torch.from_numpy(array))
+        return host.to(self.iterator.device, non_blocking=True)
+
+
+def prefetch_iterators(data, n_prefetch=4, n_workers=2):
+    # Replaces the iterators of a data object by PrefetchIterators sharing a single pool of worker processes
+    names = ['train_iter', 'sup_iter', 'val_iter', 'unsup_val_iter', 'test_iter']
+    names = [name for name in names if isinstance(getattr(data, name, None), CachedIterator)]
+    start_id = len(_PREFETCH_SOURCES)
+    _PREFETCH_SOURCES.extend(getattr(data, name) for name in names)
+    pool = multiprocessing.get_context('fork').Pool(n_workers)
+    for i, name in enumerate(names):
+        setattr(data, name, PrefetchIterator(getattr(data, name), start_id + i, pool, n_prefetch))
+    data.prefetch_pool = pool
+    return pool
+
+
+def close_prefetch(data):
+    # Stops the worker processes of prefetch_iterators and drops the data object's iterators from the prefetch sources
+    pool = getattr(data, 'prefetch_pool', None)
+    if pool is None:
+        return
+    pool.terminate()
+    pool.join()
+    for name in ['train_iter', 'sup_iter', 'val_iter', 'unsup_val_iter', 'test_iter']:
+        iterator = getattr(data, name, None)
+        if isinstance(iterator, PrefetchIterator):
+            _PREFETCH_SOURCES[iterator.source_id] = None
+    data.prefetch_pool = None
+
+
+class PackedLMIterator:
+    # Truncated BPTT iterator over a token stream: the stream is cut into batch_size contiguous rows, and each batch is
+    # the next window of bptt_len tokens of every row, plus the last token of the previous window (to serve as x_prev).
+    # Rows continue from one batch to the next, so that recurrent states can be carried across batches (see
+    # h_params.contiguous_lm), and no padding is needed. The last window of a pass may be shorter.
+    def __init__(self, stream, batch_size, bptt_len, device):
+        n_columns = (len(stream) - 1) // batch_size
+        self.dataset = stream
+        self.rows = np.asarray(stream[:batch_size * n_columns + 1], dtype=np.int64)
+        self.n_columns = n_columns
+        self.batch_size = batch_size
+        self.bptt_len = bptt_len
+        self.device = device
+        self.epoch = 0
+
+    def __len__(self):
+        return int(math.ceil((self.n_columns - 1) / self.bptt_len))
+
+    def init_epoch(self):
+        self.epoch += 1
+
+    def __iter__(self):
+        rows = self.rows[:self.batch_size * self.n_columns].reshape(self.batch_size, self.n_columns)
+        for start in range(0, self.n_columns - 1, self.bptt_len):
+            text = np.ascontiguousarray(rows[:, start:start + self.bptt_len + 1])
+            yield CachedBatch(torch.from_numpy(text).to(self.device))
+
+
+def packed_lm_iterators(splits, vocab, batch_size, max_len, device):
+    # Numericalizes the sentences of language modeling datasets into <eos> separated streams and makes PackedLMIterators
+    # with max_len wide batches (max_len-1 new tokens per batch)
+    unk_idx, eos_idx = vocab.stoi['<unk>'], vocab.stoi['<eos>']
+    iterators = []
+    for split in splits:
+        stream = [eos_idx]
+        for ex in split:
+            stream.extend(vocab.stoi.get(token, unk_idx) for token in ex.text)
+            stream.append(eos_idx)
+        iterators.append(PackedLMIterator(np.array(stream, dtype=np.int64), batch_size, max_len - 1, device))
+    return iterators
+
+
+def shuffled_orders(seed, *sizes):
+    # Same permutations as seeding numpy then calling np.random.shuffle on each example list in turn
+    np.random.seed(seed)
+    orders = []
+    for size in sizes:
+        order = np.arange(size)
+        np.random.shuffle(order)
+        orders.append(order)
+    return orders
+
+
+def cached_iterators(train, val, test, unsup_train, unsup_val, vocab, tags, batch_size, device, max_len,
+                     unsup_val_batch_size=None, sup_shuffle=True, bucketing=False, max_tokens=None):
+    # Returns the train, unsup_val, sup, val and test iterators the data classes expose
+    kwargs = {'bucketing': bucketing, 'max_tokens': max_tokens}
+    train_iter = CachedIterator(unsup_train, batch_size, device, True, max_len, vocab, **kwargs)
+    unsup_val_iter = CachedIterator(unsup_val, unsup_val_batch_size or batch_size, device, False, max_len, vocab, tags,
+                                    **kwargs)
+    sup_iter = CachedIterator(train, batch_size, device, sup_shuffle, max_len, vocab, tags, **kwargs)
+    val_iter = CachedIterator(val, batch_size, device, False, max_len, vocab, tags, **kwargs)
+    test_iter = CachedIterator(test, batch_size, device, False, max_len, vocab, tags, **kwargs)
+    return train_iter, unsup_val_iter, sup_iter, val_iter, test_iter
+
+
 class LanguageModelingDataset(data.Dataset):
     """Defines a dataset for language modeling."""
 
@@ -626,11 +1367,9 @@ class LanguageModelingDataset(data.Dataset):
         with io.open(path, encoding=encoding) as f:
             for i, line in enumerate(f):
                 processed_line = text_field.preprocess(line)
-                for sentence in ' '.join(processed_line).replace('! ', '<spl>')\
-                       .replace('? ', '<spl>').replace('. ', '<spl>').split('<spl>'):
-                   if len(sentence) > 1 and '=' not in sentence:
-                       examples.append(data.Example.fromlist([(sentence+'.').split(' ')], fields))
-                       seq_lens.append(len(sentence.split(' ')))
+                for sentence in split_sentences(processed_line):
+                    examples.append(data.Example.fromlist([sentence], fields))
+                    seq_lens.append(len(sentence) - 1)
                 # if len(processed_line) > 1 and not any(['=' in tok for tok in  processed_line]):
                 #     examples.append(data.Example.fromlist([processed_line], fields))
             print("Mean length: ", sum(seq_lens)/len(seq_lens), ' Quantiles .25, 0.5, 0.7, and 0.9 :',
@@ -639,6 +1378,189 @@ class LanguageModelingDataset(data.Dataset):
         super(LanguageModelingDataset, self).__init__(
             examples, fields, **kwargs)
 
+    @classmethod
+    def streaming_splits(cls, text_field, root='.data', train=None, validation=None, test=None, shard_size=100000):
+        # StreamingLanguageModelingDatasets over the files splits would load (downloaded the same way), None for the
+        # splits that are None
+        path = cls.download(root)
+        return tuple(StreamingLanguageModelingDataset(os.path.join(path, name), text_field, shard_size)
+                     if name is not None else None for name in (train, validation, test))
+
+
+def split_sentences(tokens):
+    # Splits a preprocessed line on sentence ending punctuation, drops headers ('=') and returns each sentence's tokens
+    # ended with '.'
+    sentences = []
+    for sentence in ' '.join(tokens).replace('! ', '<spl>').replace('? ', '<spl>').replace('. ', '<spl>').split('<spl>'):
+        if len(sentence) > 1 and '=' not in sentence:
+            sentences.append((sentence+'.').split(' '))
+    return sentences
+
+
+class LengthStats:
+    # One pass, bounded memory length statistics: exact mean, quantiles from a length histogram where lengths above
+    # max_bin share the last bin
+    def __init__(self, max_bin=1024):
+        self.counts = np.zeros(max_bin + 1, dtype=np.int64)
+        self.total = 0
+        self.n = 0
+
+    def update(self, lens):
+        lens = np.asarray(lens, dtype=np.int64)
+        self.counts += np.bincount(np.minimum(lens, len(self.counts) - 1), minlength=len(self.counts))
+        self.total += int(lens.sum())
+        self.n += len(lens)
+
+    def mean(self):
+        return self.total / max(self.n, 1)
+
+    def quantiles(self, qs):
+        cumulative = np.cumsum(self.counts)
+        return np.searchsorted(cumulative, np.asarray(qs) * self.n, side='left')
+
+
+class StreamingLanguageModelingDataset:
+    # Streaming counterpart of LanguageModelingDataset for corpora that don't fit in memory: the file is read in
+    # shards of shard_size sentences, which are split, numericalized and batched on the fly by StreamingIterator.
+    # Sentences are the same as those of LanguageModelingDataset, ended by the text field's eos token if it has one.
+    def __init__(self, path, text_field=None, shard_size=100000, encoding='utf-8', lower=True):
+        self.path = path
+        self.preprocess = text_field.preprocess if text_field is not None else (lambda line: tokenize(line, lower))
+        self.eos = text_field.eos_token if text_field is not None else None
+        self.shard_size = shard_size
+        self.encoding = encoding
+        self.stats = None
+        self.estimated_len = None
+
+    def sentences(self):
+        with io.open(self.path, encoding=self.encoding) as f:
+            for line in f:
+                for sentence in split_sentences(self.preprocess(line)):
+                    yield sentence
+
+    def shards(self):
+        # The length statistics are kept from the first pass that goes over the whole file
+        shard, stats = [], LengthStats()
+        for sentence in self.sentences():
+            shard.append(sentence)
+            if len(shard) == self.shard_size:
+                stats.update([len(sentence) - 1 for sentence in shard])
+                yield shard
+                shard = []
+        if shard:
+            stats.update([len(sentence) - 1 for sentence in shard])
+            yield shard
+        if self.stats is None:
+            self.stats = stats
+
+    def __len__(self):
+        # Exact once a pass went over the whole file, before that extrapolated from the first shard's size in bytes so
+        # that the length doesn't cost a pass
+        if self.stats is not None:
+            return self.stats.n
+        if self.estimated_len is None:
+            n_sentences, n_bytes = 0, 0
+            with io.open(self.path, 'rb') as f:
+                for raw_line in f:
+                    n_bytes += len(raw_line)
+                    n_sentences += len(split_sentences(self.preprocess(raw_line.decode(self.encoding))))
+                    if n_sentences >= self.shard_size:
+                        break
+            self.estimated_len = int(round(n_sentences * os.path.getsize(self.path) / max(n_bytes, 1)))
+        return self.estimated_len
+
+    def length_stats(self):
+        if self.stats is None:
+            for _ in self.shards():
+                pass
+            print("Mean length: ", self.stats.mean(), ' Approximate quantiles .25, 0.5, 0.7, and 0.9 :',
+                  self.stats.quantiles([0.25, 0.5, 0.7, 0.9, 0.95, 0.99]))
+        return self.stats
+
+    def build_vocab(self, specials=('<unk>', '<pad>', '<go>', '<eos>'), max_size=None):
+        # Counts words, and the length statistics in the same pass
+        counter = Counter()
+        for shard in self.shards():
+            for sentence in shard:
+                counter.update(sentence)
+        return build_vocab(counter, list(specials), max_size)
+
+    def numericalize(self, shard, vocab, max_len=None):
+        # Like Field(fix_length=max_len, init_token, eos_token), sentences are truncated to leave room for <go> and
+        # the eos token before the latter is appended
+        unk_idx = vocab.stoi['<unk>']
+        if self.eos is not None:
+            truncate = max_len - 2 if max_len is not None else None
+            shard = [sentence[:truncate] + [self.eos] for sentence in shard]
+        lens = np.array([len(sentence) for sentence in shard], dtype=np.int64)
+        offsets = np.zeros(len(shard) + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        tokens = np.array([vocab.stoi.get(token, unk_idx) for sentence in shard for token in sentence], dtype=np.int64)
+        return CachedSplit(tokens, offsets)
+
+
+class StreamingIterator:
+    # Batches a StreamingLanguageModelingDataset shard by shard with CachedIterators, so that only one shard is held in
+    # memory. Shuffling happens inside shards. The length is approximate when batches are token budgeted, or before a
+    # first complete pass over the file. Passes can be interrupted and resumed like those of CachedIterator.
+    def __init__(self, dataset, batch_size, device, shuffle, max_len, vocab, seed=42, bucketing=False,
+                 max_tokens=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.max_len = max_len
+        self.vocab = vocab
+        self.random_state = np.random.RandomState(seed)
+        self.epoch = 0
+        self.bucketing = bucketing
+        self.max_tokens = max_tokens
+        self.position, self.pass_state, self.resume_position = 0, None, 0
+
+    def __len__(self):
+        # Batches don't cross shards
+        n_full_shards, last_shard = divmod(len(self.dataset), self.dataset.shard_size)
+        n_batches = n_full_shards * int(math.ceil(self.dataset.shard_size / self.batch_size)) + \
+            int(math.ceil(last_shard / self.batch_size))
+        if self.max_tokens is not None:
+            width = min(self.dataset.stats.mean() + 1, self.max_len) if self.dataset.stats is not None else self.max_len
+            n_batches = int(math.ceil(len(self.dataset) * width / self.max_tokens))
+        return n_batches
+
+    def init_epoch(self):
+        self.epoch += 1
+
+    def pass_batches(self):
+        # (shard iterator, batch indices) pairs of a new pass, without the batches served before the pass was
+        # interrupted (see load_state_dict). The shards of these batches are still read to replay the shuffling.
+        self.pass_state = self.random_state.get_state()
+        self.position, skip, self.resume_position = self.resume_position, self.resume_position, 0
+        for shard in self.dataset.shards():
+            iterator = CachedIterator(self.dataset.numericalize(shard, self.vocab, self.max_len), self.batch_size,
+                                      self.device, self.shuffle, self.max_len, self.vocab,
+                                      seed=self.random_state.randint(2**31), bucketing=self.bucketing,
+                                      max_tokens=self.max_tokens)
+            batches = iterator.batch_indices()
+            for idx in batches[skip:]:
+                yield iterator, idx
+            skip = max(0, skip - len(batches))
+
+    def state_dict(self):
+        state = self.pass_state if self.pass_state is not None else self.random_state.get_state()
+        return {'epoch': self.epoch, 'position': self.position,
+                'random_state': (state[0], state[1].tolist()) + tuple(state[2:])}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.random_state.set_state(state['random_state'])
+        self.resume_position = state['position']
+
+    def __iter__(self):
+        for iterator, idx in self.pass_batches():
+            self.position += 1
+            yield iterator.make_batch(idx)
+        self.position, self.pass_state = 0, None
+
 
 class MyPennTreebank(LanguageModelingDataset):
     """The Penn Treebank dataset.
@@ -659,7 +1581,7 @@ class MyPennTreebank(LanguageModelingDataset):
     @classmethod
     def splits(cls, text_field, root='.data', train='ptb.train.txt',
                validation='ptb.valid.txt', test='ptb.test.txt',
-               **kwargs):
+               streaming=False, **kwargs):
         """Create dataset objects for splits of the Penn Treebank dataset.
 
         Arguments:
@@ -671,6 +1593,9 @@ class MyPennTreebank(LanguageModelingDataset):
             test: The filename of the test data, or None to not load the test
                 set. Default: 'ptb.test.txt'.
         """
+        if streaming:
+            # Read shard by shard at each pass instead of being held in memory
+            return cls.streaming_splits(text_field, root, train, validation, test, **kwargs)
         return super(MyPennTreebank, cls).splits(
             root=root, train=train, validation=validation, test=test,
             text_field=text_field, **kwargs)
@@ -721,7 +1646,7 @@ class YahooLM(LanguageModelingDataset):
     @classmethod
     def splits(cls, text_field, root='.data', train='train.txt',
                validation='dev.txt', test='dev.txt',
-               **kwargs):
+               streaming=False, **kwargs):
         """Create dataset objects for splits of the Penn Treebank dataset.
 
         Arguments:
@@ -733,6 +1658,9 @@ class YahooLM(LanguageModelingDataset):
             test: The filename of the test data, or None to not load the test
                 set. Default: 'ptb.test.txt'.
         """
+        if streaming:
+            # Read shard by shard at each pass instead of being held in memory
+            return cls.streaming_splits(text_field, root, train, validation, test, **kwargs)
         return super(YahooLM, cls).splits(
             root=root, train=train, validation=validation, test=test,
             text_field=text_field, **kwargs)
@@ -776,7 +1704,7 @@ class MyWikiText2(LanguageModelingDataset):
     @classmethod
     def splits(cls, text_field, root='.data', train='wiki.train.tokens',
                validation='wiki.valid.tokens', test='wiki.test.tokens',
-               **kwargs):
+               streaming=False, **kwargs):
         """Create dataset objects for splits of the WikiText-2 dataset.
 
         This is the most flexible way to use the dataset.
@@ -792,6 +1720,9 @@ class MyWikiText2(LanguageModelingDataset):
             test: The filename of the test data, or None to not load the test
                 set. Default: 'wiki.test.tokens'.
         """
+        if streaming:
+            # Read shard by shard at each pass instead of being held in memory
+            return cls.streaming_splits(text_field, root, train, validation, test, **kwargs)
         return super(MyWikiText2, cls).splits(
             root=root, train=train, validation=validation, test=test,
             text_field=text_field, **kwargs)
@@ -837,7 +1768,7 @@ class NLIGen(LanguageModelingDataset):
     @classmethod
     def splits(cls, text_field, root='.data', train='train.txt',
                validation='test.txt', test='test.txt',
-               **kwargs):
+               streaming=False, **kwargs):
         """Create dataset objects for splits of the WikiText-2 dataset.
 
         This is the most flexible way to use the dataset.
@@ -853,6 +1784,9 @@ class NLIGen(LanguageModelingDataset):
             test: The filename of the test data, or None to not load the test
                 set. Default: 'wiki.test.tokens'.
         """
+        if streaming:
+            # Read shard by shard at each pass instead of being held in memory
+            return cls.streaming_splits(text_field, root, train, validation, test, **kwargs)
         return super(NLIGen, cls).splits(
             root=root, train=train, validation=validation, test=test,
             text_field=text_field, **kwargs)
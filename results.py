@@ -0,0 +1,235 @@
+# This file holds the results store of the experiments: a SQLite database in WAL mode next to each --result_csv
+# (imdb4.csv -> imdb4.db), to which any number of concurrent runs can append their row. The csv is re-exported from
+# the database after each append, in the same format as before, so that existing result files and notebooks keep
+# working. Rows of a csv written before the database existed are imported when the database is created.
+# Examples:
+#   python results.py imdb4.csv            # re-exports imdb4.csv from imdb4.db
+#   python results.py imdb4.csv --perf     # same, with the throughput and memory columns
+#   python results.py imdb4.csv --rungs    # exports the successive halving rungs of sweep.py to imdb4_rungs.csv
+import argparse
+import os
+import sqlite3
+import threading
+from time import time
+
+import torch
+
+# Columns of the result csv, in order
+RESULT_COLUMNS = ['test_name', 'dev_index', 'loss_type', 'supervision_proportion', 'generation_weight',
+                  'unsupervision_proportion', 'test_accuracy', 'dev_accuracy', 'train_accuracy', 'pp_ub', 'best_epoch',
+                  'embedding_dim', 'pos_embedding_dim', 'z_size', 'text_rep_l', 'text_rep_h', 'encoder_h',
+                  'encoder_l', 'pos_h', 'pos_l', 'decoder_h', 'decoder_l', 'training_iw_samples', 'is_tied',
+                  'pretrained']
+# Performance columns, only stored in the database (and in csv exports with perf=True)
+PERF_COLUMNS = ['wall_time', 'steps_per_s', 'tokens_per_s', 'peak_memory_mb', 'finished_at']
+# Hash of all the flags that define a run (see sent_train.flags_hash), only stored in the database. It is empty for the
+# rows imported from a csv.
+KEY_COLUMNS = ['flags_hash']
+# Columns of the (partial) results recorded at each rung of sweep.py's successive halving
+RUNG_COLUMNS = ['test_name', 'dev_index', 'loss_type', 'supervision_proportion', 'rung', 'supervision_epoch',
+                'dev_accuracy', 'status', 'recorded_at']
+
+
+def db_path(result_csv):
+    return os.path.splitext(result_csv)[0] + '.db'
+
+
+def rungs_path(result_csv):
+    return os.path.splitext(result_csv)[0] + '_rungs.csv'
+
+
+def write_csv(path, columns, rows):
+    # Written to a temporary file then renamed, so that readers never see a partial csv
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(', '.join(columns) + '\n')
+        for row in rows:
+            f.write(', '.join('' if row[c] is None else row[c] for c in columns) + '\n')
+    os.replace(tmp_path, path)
+
+
+class ResultStore:
+    def __init__(self, result_csv):
+        self.result_csv = result_csv
+        self.path = db_path(result_csv)
+        # Concurrent writers wait for each other instead of failing (appends only hold the lock for a few ms)
+        self.connection = sqlite3.connect(self.path, timeout=600, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            exists = self.connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='results'"
+                                             ).fetchone()
+            if not exists:
+                self.connection.execute('CREATE TABLE results (id INTEGER PRIMARY KEY AUTOINCREMENT, {})'.format(
+                    ', '.join('{} TEXT'.format(c) for c in RESULT_COLUMNS + PERF_COLUMNS + KEY_COLUMNS)))
+                self.import_csv()
+            # Databases created before a column existed
+            existing = [row[1] for row in self.connection.execute('PRAGMA table_info(results)')]
+            for column in RESULT_COLUMNS + PERF_COLUMNS + KEY_COLUMNS:
+                if column not in existing:
+                    self.connection.execute('ALTER TABLE results ADD COLUMN {} TEXT'.format(column))
+            self.connection.execute('CREATE TABLE IF NOT EXISTS rungs (id INTEGER PRIMARY KEY AUTOINCREMENT, {})'
+                                    .format(', '.join('{} TEXT'.format(c) for c in RUNG_COLUMNS)))
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def import_csv(self):
+        # Rows of a pre-existing csv, so that the first export doesn't drop them
+        if not os.path.exists(self.result_csv):
+            return
+        with open(self.result_csv) as f:
+            header = f.readline().rstrip('\n').split(', ')
+            rows = [dict(zip(header, line.rstrip('\n').split(', '))) for line in f if line.strip()]
+        for row in rows:
+            self.insert(row)
+        print("Imported {} rows from {} into {}".format(len(rows), self.result_csv, self.path))
+
+    def insert(self, row):
+        columns = [c for c in RESULT_COLUMNS + PERF_COLUMNS + KEY_COLUMNS if c in row]
+        self.connection.execute('INSERT INTO results ({}) VALUES ({})'.format(', '.join(columns),
+                                                                             ', '.join('?' * len(columns))),
+                                [None if row[c] is None else str(row[c]) for c in columns])
+
+    def append(self, row, export=True):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.insert(dict(row, finished_at=row.get('finished_at', time())))
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        if export:
+            self.export_csv()
+
+    def append_rung(self, row):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = dict(row, recorded_at=row.get('recorded_at', time()))
+            columns = [c for c in RUNG_COLUMNS if c in row]
+            self.connection.execute('INSERT INTO rungs ({}) VALUES ({})'.format(', '.join(columns),
+                                                                               ', '.join('?' * len(columns))),
+                                    [None if row[c] is None else str(row[c]) for c in columns])
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def rows(self, perf=False, keys=False):
+        columns = RESULT_COLUMNS + (PERF_COLUMNS if perf else []) + (KEY_COLUMNS if keys else [])
+        cursor = self.connection.execute('SELECT {} FROM results ORDER BY id'.format(', '.join(columns)))
+        return [dict(zip(columns, values)) for values in cursor]
+
+    def rung_rows(self):
+        cursor = self.connection.execute('SELECT {} FROM rungs ORDER BY id'.format(', '.join(RUNG_COLUMNS)))
+        return [dict(zip(RUNG_COLUMNS, values)) for values in cursor]
+
+    def export_csv(self, path=None, perf=False):
+        write_csv(path or self.result_csv, RESULT_COLUMNS + (PERF_COLUMNS if perf else []), self.rows(perf))
+
+    def export_rungs(self, path=None):
+        write_csv(path or rungs_path(self.result_csv), RUNG_COLUMNS, self.rung_rows())
+
+    def close(self):
+        self.connection.close()
+
+
+class RunMeter:
+    # Wall-clock time, training steps/s, training tokens/s (padding excluded) and peak memory of a run. On GPUs the
+    # peak is the allocator's peak since the run started. On CPU, ru_maxrss would be the peak of the whole process
+    # (including earlier runs of a sweep), so the resident set size is sampled by a thread during the run instead, and
+    # the peak is left empty when it can't be read (no /proc).
+    def __init__(self, device, sample_every=0.05):
+        self.device = device
+        self.start = time()
+        self.train_start, self.train_time = None, 0.
+        self.steps, self.tokens = 0, 0
+        self.peak_rss, self.sampler = None, None
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+            return
+        self.peak_rss = self.rss()
+        if self.peak_rss is not None:
+            self.stopped = threading.Event()
+            self.sampler = threading.Thread(target=self.sample, args=(sample_every,), daemon=True)
+            self.sampler.start()
+
+    @staticmethod
+    def rss():
+        # Resident set size in bytes, None where /proc isn't available
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return None
+
+    def sample(self, sample_every):
+        while not self.stopped.wait(sample_every):
+            self.update_peak()
+
+    def update_peak(self):
+        # Failed reads are skipped
+        rss = self.rss()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def start_training(self):
+        self.train_start = time()
+
+    def step(self, n_steps, n_tokens):
+        # n_tokens may be a device tensor, it is only read back in row()
+        self.steps += n_steps
+        self.tokens += n_tokens
+
+    def stop_training(self):
+        if self.train_start is not None:
+            self.train_time += time() - self.train_start
+            self.train_start = None
+
+    def peak_memory_mb(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device) / 2**20
+        if self.peak_rss is None:
+            return None
+        self.update_peak()
+        return self.peak_rss / 2**20
+
+    def close(self):
+        if self.sampler is not None:
+            self.stopped.set()
+            self.sampler.join()
+            self.sampler = None
+
+    def row(self):
+        self.stop_training()
+        peak_memory_mb = self.peak_memory_mb()
+        self.close()
+        return {'wall_time': time() - self.start,
+                'steps_per_s': self.steps / self.train_time if self.train_time else 0.,
+                'tokens_per_s': float(self.tokens) / self.train_time if self.train_time else 0.,
+                'peak_memory_mb': peak_memory_mb}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("result_csv", type=str)
+    parser.add_argument("--output", default=None, type=str)  # default: overwrite result_csv
+    parser.add_argument('--perf', dest='perf', action='store_true')
+    parser.add_argument('--no-perf', dest='perf', action='store_false')
+    parser.set_defaults(perf=False)
+    parser.add_argument('--rungs', dest='rungs', action='store_true')  # default output: <result_csv>_rungs.csv
+    parser.add_argument('--no-rungs', dest='rungs', action='store_false')
+    parser.set_defaults(rungs=False)
+    flags = parser.parse_args()
+    store = ResultStore(flags.result_csv)
+    if flags.rungs:
+        store.export_rungs(flags.output)
+    else:
+        store.export_csv(flags.output, perf=flags.perf)
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,44 @@
 # This file will implement the main training loop for a model
 from time import time
 import argparse
+import gc
 import os
+import json
+import hashlib
+import signal
+import sys
 
 from torch import device
 import torch
 from torch import optim
 import numpy as np
 
-from data_prep import HuggingIMDB2, HuggingAGNews, HuggingYelp, UDPoSDaTA
-from sentence_classification.models import SSSentenceClassification as Model
-from sentence_classification.h_params import DefaultSSSentenceClassificationHParams as HParams
+from data_prep import HuggingIMDB2, HuggingAGNews, HuggingYelp, UDPoSDaTA, prefetch_iterators, close_prefetch, \
+    VOCAB_LIMIT
+from sentence_classification.models import SSSentenceClassification as Model, StepTimer
+from sentence_classification.h_params import DefaultSSSentenceClassificationHParams as HParams, \
+    ROOT_CHECKPOINTING_PATH
 from sentence_classification.graphs import *
 from components.criteria import *
+from components.bayesnets import VertexProfiler
+from results import ResultStore, RunMeter, RESULT_COLUMNS, db_path
+# Flags the reconstruction phase depends on
+WARM_START_FLAGS = ['dataset', 'max_len', 'batch_size', 'grad_accu', 'unsupervision_proportion', 'generation_weight',
+                    'embedding_dim', 'tied_embeddings', 'pretrained_embeddings', 'pos_embedding_dim', 'z_size',
+                    'text_rep_l', 'text_rep_h', 'encoder_h', 'encoder_l', 'pos_h', 'pos_l', 'decoder_h', 'decoder_l',
+                    'highway', 'markovian', 'losses', 'training_iw_samples', 'anneal_kl0', 'anneal_kl1', 'grad_clip',
+                    'kl_th', 'dropout', 'word_dropout', 'l2_reg', 'lr', 'bucketing', 'max_tokens']
+# Flags that don't change what a run trains (where it runs, and how it is logged, profiled or checkpointed), left out of
+# flags_hash
+BOOKKEEPING_FLAGS = ['test_name', 'mode', 'result_csv', 'device', 'prefetch', 'prefetch_workers', 'shared_data',
+                     'skip_done', 'checkpoint_every', 'async_save', 'metrics_flush_every', 'profile_steps',
+                     'profile_vertices']
+# Result csv columns (other than test_name, dev_index and loss_type) that identify a run's hyper-parameters in the rows
+# imported from a csv, which have no flags_hash
+RESULT_HP_COLUMNS = ['supervision_proportion', 'generation_weight', 'unsupervision_proportion', 'embedding_dim',
+                     'pos_embedding_dim', 'z_size', 'text_rep_l', 'text_rep_h', 'encoder_h', 'encoder_l', 'pos_h',
+                     'pos_l', 'decoder_h', 'decoder_l', 'training_iw_samples', 'is_tied', 'pretrained']
+DATASETS = {'imdb': HuggingIMDB2, 'ag_news': HuggingAGNews, 'yelp': HuggingYelp, 'ud': UDPoSDaTA}
 parser = argparse.ArgumentParser()
 
 # Training and Optimization
@@ -70,91 +96,199 @@ parser.add_argument("--lr", default=4e-3, type=float)
 parser.add_argument("--lr_reduction", default=4., type=float)
 parser.add_argument("--wait_epochs", default=4, type=float) # changed from 4 to 8 for agnews
 parser.add_argument("--stopping_crit", default="early", choices=["convergence", "early"], type=str)
+# Batching: bucketing groups examples of similar lengths and pads each batch to its longest example, max_tokens
+# additionally replaces the batch_size cap with a padded token budget per batch
+parser.add_argument('--bucketing', dest='bucketing', action='store_true')
+parser.add_argument('--no-bucketing', dest='bucketing', action='store_false')
+parser.set_defaults(bucketing=False)
+parser.add_argument("--max_tokens", default=None, type=int)
+# Prefetching: number of batches collated ahead by background worker processes (0 disables it)
+parser.add_argument("--prefetch", default=0, type=int)
+parser.add_argument("--prefetch_workers", default=2, type=int)
+# Shared data: runs on the same node share a single in-memory copy of the token cache
+parser.add_argument('--shared_data', dest='shared_data', action='store_true')
+parser.add_argument('--no-shared_data', dest='shared_data', action='store_false')
+parser.set_defaults(shared_data=False)
+# Warm start: runs sharing everything but their supervised data fork from a cached reconstruction phase checkpoint
+parser.add_argument('--warm_start', dest='warm_start', action='store_true')
+parser.add_argument('--no-warm_start', dest='warm_start', action='store_false')
+parser.set_defaults(warm_start=False)
+# Runs that already have a row in --result_csv are skipped (use --no-skip_done to run them again)
+parser.add_argument('--skip_done', dest='skip_done', action='store_true')
+parser.add_argument('--no-skip_done', dest='skip_done', action='store_false')
+parser.set_defaults(skip_done=True)
+# Resume checkpoints (see Model.save_resume) are written every checkpoint_every steps (0: only when the run receives
+# SIGTERM or SIGUSR1, e.g. from slurm before a preemption or the time limit), and loaded when the run is restarted
+parser.add_argument("--checkpoint_every", default=0, type=int)
+# Keep the best weights in memory and write their checkpoint in a background thread instead of blocking training
+parser.add_argument('--async_save', dest='async_save', action='store_true')
+parser.add_argument('--no-async_save', dest='async_save', action='store_false')
+parser.set_defaults(async_save=False)
+# Training metrics stay on the device and are written to Tensorboard every metrics_flush_every steps
+parser.add_argument("--metrics_flush_every", default=100, type=int)
+# Times the phases of the training steps (data, forward passes, losses, backward, optimizer, ...), written to
+# Tensorboard and summarized in tb_logs/<test_name>/step_timings.json at the end of training
+parser.add_argument('--profile_steps', dest='profile_steps', action='store_true')
+parser.add_argument('--no-profile_steps', dest='profile_steps', action='store_false')
+parser.set_defaults(profile_steps=False)
+# Profiles each vertex of the inference and generation networks during training (synchronizes the device around each
+# vertex): prints a table at the end of training and writes a Chrome trace to tb_logs/<test_name>/vertex_trace.json
+parser.add_argument('--profile_vertices', dest='profile_vertices', action='store_true')
+parser.add_argument('--no-profile_vertices', dest='profile_vertices', action='store_false')
+parser.set_defaults(profile_vertices=False)
 
-flags = parser.parse_args()
-if flags.divide_by != 1:
-    flags.embedding_dim = int(flags.embedding_dim/flags.divide_by)
-    flags.z_size = int(flags.z_size/flags.divide_by)
-    flags.pos_h = int(flags.pos_h/flags.divide_by)
-    flags.pos_embedding_dim = int(flags.pos_embedding_dim/flags.divide_by)
-    flags.encoder_h = int(flags.encoder_h/flags.divide_by)
-    flags.decoder_h = int(flags.decoder_h/flags.divide_by)
-
-# Set this to true to force training slurm scripts to rather perform evaluation
-FORCE_EVAL = False
-if FORCE_EVAL:
-    flags.mode = "eval"
-    flags.result_csv = "imdbeval.csv"
-# Manual Settings, Deactivate before pushing
-if False:
-    flags.losses = 'S'
-    flags.batch_size = 32
-    flags.grad_accu = 1
-    flags.max_len = 256
-    flags.encoder_h = 512
-    flags.test_name = "SSVAE/IMDB/test7"
-    flags.unsupervision_proportion = 1
-    flags.supervision_proportion = 0.125
-    flags.dev_index = 5
-    #flags.pretrained_embeddings = True[38. 42. 49. 54. 72.]
-    flags.dataset = "imdb"
-
-
-if False:
-    flags.losses = 'S'
-    flags.batch_size = 32
-    flags.grad_accu = 1
-    flags.max_len = 256
-    flags.test_name = "SSVAE/IMDB/test8"
-    flags.unsupervision_proportion = 1
-    flags.supervision_proportion = 1#0.125
-    flags.dev_index = 5
-    #flags.pretrained_embeddings = True
-    flags.dataset = "imdb"
-
-if flags.pretrained_embeddings:
-    flags.embedding_dim = 300
-    #flags.tied_embeddings = True
-    flags.decoder_h = flags.embedding_dim
-
-# torch.autograd.set_detect_anomaly(True)
-# flags.wait_epochs = int(flags.wait_epochs /flags.supervision_proportion )
-assert flags.dev_index in (1, 2, 3, 4, 5)
-Data = {'imdb': HuggingIMDB2, 'ag_news': HuggingAGNews, 'yelp': HuggingYelp, 'ud': UDPoSDaTA}[flags.dataset]
-this_graph = {'imdb': get_sentiment_graph, 'ag_news': get_sentiment_graph, 'yelp': get_sentiment_graph,
-              'ud': get_postag_graph}[flags.dataset]
-MAX_LEN = flags.max_len
-BATCH_SIZE = flags.batch_size
-GRAD_ACCU = flags.grad_accu
-N_EPOCHS = flags.n_epochs
-TEST_FREQ = flags.test_freq
-COMPLETE_TEST_FREQ = flags.complete_test_freq
-SUP_PROPORTION = flags.supervision_proportion
-DEV_INDEX = flags.dev_index
-UNSUP_PROPORTION = flags.unsupervision_proportion
-DEVICE = device(flags.device)
-# This prevents illegal memory access on multigpu machines (unresolved issue on torch's github)
-if flags.device.startswith('cuda'):
-    torch.cuda.set_device(int(flags.device[-1]))
-LOSSES = {'S': [Supervision],
-          'SSVAE': [Supervision, ELBo],
-          'SSPIWO': [Supervision, IWLBo],
-          'SSiPIWO': [Supervision, IWLBo],
-          'SSIWAE': [Supervision, IWLBo],
-          'VAE': [ELBo],
-          'Reconstruction': [Reconstruction]}[flags.losses]
-#  LOSSES = [IWLBo]
-ANNEAL_KL = [flags.anneal_kl0*flags.grad_accu, flags.anneal_kl1*flags.grad_accu] if flags.losses != 'S' else [0, 0]
-LOSS_PARAMS = [1] if 'SS' not in flags.losses else [1/flags.generation_weight, 1]
-if flags.grad_accu > 1:
-    LOSS_PARAMS = [w/flags.grad_accu for w in LOSS_PARAMS]
-PIWO = flags.losses == 'SSPIWO'
-IPIWO = flags.losses == 'SSiPIWO'
+
+def set_flags(args=None):
+    # Parses the command line (or the given argument list) and sets the experiment's module level settings. This lets
+    # sweep.py run several experiments in the same process.
+    global flags, Data, this_graph, MAX_LEN, BATCH_SIZE, GRAD_ACCU, N_EPOCHS, TEST_FREQ, COMPLETE_TEST_FREQ, \
+        SUP_PROPORTION, DEV_INDEX, UNSUP_PROPORTION, DEVICE, LOSSES, ANNEAL_KL, LOSS_PARAMS, PIWO, IPIWO
+    flags = parser.parse_args(args)
+    if flags.divide_by != 1:
+        flags.embedding_dim = int(flags.embedding_dim/flags.divide_by)
+        flags.z_size = int(flags.z_size/flags.divide_by)
+        flags.pos_h = int(flags.pos_h/flags.divide_by)
+        flags.pos_embedding_dim = int(flags.pos_embedding_dim/flags.divide_by)
+        flags.encoder_h = int(flags.encoder_h/flags.divide_by)
+        flags.decoder_h = int(flags.decoder_h/flags.divide_by)
+
+    # Set this to true to force training slurm scripts to rather perform evaluation
+    FORCE_EVAL = False
+    if FORCE_EVAL:
+        flags.mode = "eval"
+        flags.result_csv = "imdbeval.csv"
+    # Manual Settings, Deactivate before pushing
+    if False:
+        flags.losses = 'S'
+        flags.batch_size = 32
+        flags.grad_accu = 1
+        flags.max_len = 256
+        flags.encoder_h = 512
+        flags.test_name = "SSVAE/IMDB/test7"
+        flags.unsupervision_proportion = 1
+        flags.supervision_proportion = 0.125
+        flags.dev_index = 5
+        #flags.pretrained_embeddings = True[38. 42. 49. 54. 72.]
+        flags.dataset = "imdb"
+
+
+    if False:
+        flags.losses = 'S'
+        flags.batch_size = 32
+        flags.grad_accu = 1
+        flags.max_len = 256
+        flags.test_name = "SSVAE/IMDB/test8"
+        flags.unsupervision_proportion = 1
+        flags.supervision_proportion = 1#0.125
+        flags.dev_index = 5
+        #flags.pretrained_embeddings = True
+        flags.dataset = "imdb"
+
+    if flags.pretrained_embeddings:
+        flags.embedding_dim = 300
+        #flags.tied_embeddings = True
+        flags.decoder_h = flags.embedding_dim
+
+    # torch.autograd.set_detect_anomaly(True)
+    # flags.wait_epochs = int(flags.wait_epochs /flags.supervision_proportion )
+    assert flags.dev_index in (1, 2, 3, 4, 5)
+    Data = DATASETS[flags.dataset]
+    this_graph = {'imdb': get_sentiment_graph, 'ag_news': get_sentiment_graph, 'yelp': get_sentiment_graph,
+                  'ud': get_postag_graph}[flags.dataset]
+    MAX_LEN = flags.max_len
+    BATCH_SIZE = flags.batch_size
+    GRAD_ACCU = flags.grad_accu
+    N_EPOCHS = flags.n_epochs
+    TEST_FREQ = flags.test_freq
+    COMPLETE_TEST_FREQ = flags.complete_test_freq
+    SUP_PROPORTION = flags.supervision_proportion
+    DEV_INDEX = flags.dev_index
+    UNSUP_PROPORTION = flags.unsupervision_proportion
+    DEVICE = device(flags.device)
+    # This prevents illegal memory access on multigpu machines (unresolved issue on torch's github)
+    if flags.device.startswith('cuda'):
+        torch.cuda.set_device(int(flags.device[-1]))
+    LOSSES = {'S': [Supervision],
+              'SSVAE': [Supervision, ELBo],
+              'SSPIWO': [Supervision, IWLBo],
+              'SSiPIWO': [Supervision, IWLBo],
+              'SSIWAE': [Supervision, IWLBo],
+              'VAE': [ELBo],
+              'Reconstruction': [Reconstruction]}[flags.losses]
+    #  LOSSES = [IWLBo]
+    ANNEAL_KL = [flags.anneal_kl0*flags.grad_accu, flags.anneal_kl1*flags.grad_accu] if flags.losses != 'S' else [0, 0]
+    LOSS_PARAMS = [1] if 'SS' not in flags.losses else [1/flags.generation_weight, 1]
+    if flags.grad_accu > 1:
+        LOSS_PARAMS = [w/flags.grad_accu for w in LOSS_PARAMS]
+    PIWO = flags.losses == 'SSPIWO'
+    IPIWO = flags.losses == 'SSiPIWO'
+
+    return flags
+
+
+# Signals received during training: running experiments save their resume checkpoint and stop at their next step
+STOP_SIGNALS = []
+
+
+def request_stop(signum, frame):
+    print("Received signal {}, saving resume checkpoints before exiting".format(signum))
+    STOP_SIGNALS.append(signum)
+
+
+def exit_if_stopped():
+    if STOP_SIGNALS:
+        sys.exit(128 + STOP_SIGNALS[0])
 
 
 def main():
-    data = Data(MAX_LEN, BATCH_SIZE, N_EPOCHS, DEVICE, UNSUP_PROPORTION, SUP_PROPORTION, DEV_INDEX,
-                flags.pretrained_embeddings)
+    for _ in experiment(flags):
+        pass
+    exit_if_stopped()
+
+
+def experiment(flags):
+    # Runs an experiment, yielding (supervision epoch, best dev accuracy) after each training step, so that several
+    # experiments can be interleaved or stopped early
+    if flags.skip_done and is_done(flags):
+        print("Skipping {}: it already has a result row in {}".format(flags.test_name, flags.result_csv))
+        return
+    for signum in (signal.SIGTERM, signal.SIGUSR1):
+        signal.signal(signum, request_stop)
+    resources = {}
+    try:
+        yield from experiment_steps(flags, resources)
+    finally:
+        release(resources)
+
+
+def release(resources):
+    # Tears down what a run holds, whether it finished, stopped on a signal or was closed early (e.g. by sweep.py's
+    # successive halving): pending checkpoint writes, buffered metrics, the Tensorboard writer, the prefetch workers,
+    # the memory sampler, and the model's memory
+    model, data, meter = resources.pop('model', None), resources.pop('data', None), resources.pop('meter', None)
+    if model is not None:
+        model.flush_saves()
+        model.metric_buffer.flush()
+        model.writer.close()
+    if data is not None:
+        close_prefetch(data)
+    if meter is not None:
+        meter.close()
+    del model, data, meter
+    gc.collect()
+    if DEVICE.type == 'cuda':
+        torch.cuda.empty_cache()
+
+
+def experiment_steps(flags, resources):
+    # Body of experiment, which registers the run's meter, data and model in resources for release
+    meter = resources['meter'] = RunMeter(DEVICE)
+    data = resources['data'] = Data(MAX_LEN, BATCH_SIZE, N_EPOCHS, DEVICE, flags.unsupervision_proportion,
+                                    flags.supervision_proportion, flags.dev_index,
+                                    flags.pretrained_embeddings, bucketing=flags.bucketing,
+                                    max_tokens=flags.max_tokens, shared=flags.shared_data)
+    if flags.prefetch:
+        prefetch_iterators(data, flags.prefetch, flags.prefetch_workers)
     h_params = HParams(len(data.vocab.itos), len(data.tags.itos), MAX_LEN, BATCH_SIZE, N_EPOCHS,
                        device=DEVICE, pos_ignore_index=data.tags.stoi['<pad>'],
                        vocab_ignore_index=data.vocab.stoi['<pad>'], decoder_h=flags.decoder_h,
@@ -169,18 +303,32 @@ def main():
                        kl_th=flags.kl_th, highway=flags.highway, losses=LOSSES, dropout=flags.dropout,
                        training_iw_samples=flags.training_iw_samples, testing_iw_samples=flags.testing_iw_samples,
                        loss_params=LOSS_PARAMS, piwo=PIWO, ipiwo=IPIWO, optimizer=optim.AdamW, markovian=flags.markovian
-                       , word_dropout=flags.word_dropout, contiguous_lm=False, tied_embeddings=flags.tied_embeddings)
+                       , word_dropout=flags.word_dropout, contiguous_lm=getattr(data, 'contiguous_lm', False),
+                       tied_embeddings=flags.tied_embeddings)
     val_iterator = iter(data.val_iter)
     supervised_iterator = iter(data.sup_iter)
     print("Launching experiment ", flags.test_name)
     print("Words: ", len(data.vocab.itos), ", Target tags: ", len(data.tags.itos), ", On device: ", DEVICE.type)
-    print("Loss Type: ", flags.losses, ", Supervision proportion: ", SUP_PROPORTION)
-    model = Model(data.vocab, data.tags, h_params, wvs=data.wvs)
+    print("Loss Type: ", flags.losses, ", Supervision proportion: ", flags.supervision_proportion)
+    model = resources['model'] = Model(data.vocab, data.tags, h_params, wvs=data.wvs)
+    model.async_save = flags.async_save
+    model.metric_buffer.flush_every = flags.metrics_flush_every
+    if flags.profile_steps:
+        model.timer = StepTimer(DEVICE, model.writer, flags.metrics_flush_every)
+    if flags.profile_vertices:
+        vertex_profiler = VertexProfiler()
+        vertex_profiler.attach('inference', model.infer_bn)
+        vertex_profiler.attach('generation', model.gen_bn)
+    if flags.warm_start and model.step == 0 and h_params.anneal_kl[0] > 0 and os.path.exists(warm_start_path(flags)):
+        checkpoint = torch.load(warm_start_path(flags), map_location='cpu')
+        model.load_state_dict(checkpoint['model_checkpoint'])
+        model.step = checkpoint['step']
+        print("Warm started from the reconstruction phase checkpoint ", warm_start_path(flags))
     if DEVICE.type == 'cuda':
         model.cuda(DEVICE)
 
     total_unsupervised_train_samples = len(data.train_iter)*BATCH_SIZE
-    total_supervised_train_samples = len(data.sup_iter.dataset.examples)
+    total_supervised_train_samples = len(data.sup_iter.dataset)
     print("Unsupervised training examples: ", total_unsupervised_train_samples,
           ", Supervised training examples: ", total_supervised_train_samples)
     current_time = time()
@@ -200,9 +348,28 @@ def main():
     mean_loss = 0
     supervision_epoch = 0
     best_epoch = -1
+    iterator_names = [name for name in ('train_iter', 'sup_iter') if hasattr(getattr(data, name), 'state_dict')]
+
+    def training_state():
+        return {'max_acc': max_acc, 'min_perp': float(min_perp), 'wait_count': wait_count, 'loss': float(loss),
+                'supervision_epoch': supervision_epoch, 'best_epoch': best_epoch, 'n_epochs': data.n_epochs,
+                'iterators': {name: getattr(data, name).state_dict() for name in iterator_names}}
+    resumed = model.load_resume() if flags.mode == 'train' else None
+    if resumed is not None:
+        max_acc, min_perp, wait_count, loss = resumed['max_acc'], resumed['min_perp'], resumed['wait_count'], \
+                                              resumed['loss']
+        supervision_epoch, best_epoch, data.n_epochs = resumed['supervision_epoch'], resumed['best_epoch'], \
+                                                       resumed['n_epochs']
+        for name, state in resumed['iterators'].items():
+            getattr(data, name).load_state_dict(state)
+    last_checkpoint = model.step
+    pad_index = data.vocab.stoi['<pad>']
     if flags.mode == 'train':
+        meter.start_training()
         while data.train_iter is not None:
+            fetch_start = time()
             for i, training_batch in enumerate(data.train_iter):
+                model.timer.add('data', time() - fetch_start)
                 if training_batch.text.shape[1] < 2:
                     print('Misshaped training sample')
                     continue
@@ -212,11 +379,15 @@ def main():
                 if model.step == h_params.anneal_kl[0]:
                     model.optimizer = h_params.optimizer(model.parameters(), **h_params.optimizer_kwargs)
                     print('Refreshed optimizer !')
-                    if model.step != 0 and not torch.isnan(loss):
+                    if model.step != 0 and not torch.isnan(torch.as_tensor(loss)):
                         model.save()
                         print('Saved model after it\'s pure reconstruction phase')
+                        if flags.warm_start and not os.path.exists(warm_start_path(flags)):
+                            save_warm_start(model, warm_start_path(flags))
                 try:
+                    fetch_start = time()
                     supervised_batch = next(supervised_iterator)
+                    model.timer.add('data', time() - fetch_start)
                 except StopIteration:
                     print("Reinitialized supervised training iterator")
                     supervision_epoch += 1
@@ -246,14 +417,21 @@ def main():
 
                 """print([' '.join(['('+data.vocab.itos[t]+' '+data.tags.itos[l]+')' for t, l in zip(text_i[1:], lab_i)]) for
                        text_i, lab_i in zip(supervised_batch.text[:2], supervised_batch.label[:2])])"""
+                # With warm starts, the reconstruction phase is unsupervised so that it doesn't depend on the fold
+                supervise = 'S' in flags.losses and not (flags.warm_start and model.step < h_params.anneal_kl[0])
                 loss = model.opt_step({'x': training_batch.text[..., 1:], 'x_prev': training_batch.text[..., :-1]}) if flags.losses != 'S' else 0
                 loss += model.opt_step({'x': supervised_batch.text[..., 1:], 'x_prev': supervised_batch.text[..., :-1],
-                                        'y': supervised_batch.label}) if 'S' in flags.losses else 0
+                                        'y': supervised_batch.label}) if supervise else 0
+                # Tokens other than padding, summed on the device so that counting them doesn't synchronize the step
+                n_tokens = ((training_batch.text != pad_index).sum() if flags.losses != 'S' else 0) + \
+                           ((supervised_batch.text != pad_index).sum() if supervise else 0)
+                meter.step((flags.losses != 'S') + supervise, n_tokens)
+                model.timer.step(n_tokens, model.step)
 
                 mean_loss += loss
                 if i % 30 == 0:
                     mean_loss /= 30
-                    print("step:{}, loss:{}, seconds/step:{}".format(model.step, mean_loss, time()-current_time))
+                    print("step:{}, loss:{}, seconds/step:{}".format(model.step, float(mean_loss), time()-current_time))
                     mean_loss = 0
 
                 if int(model.step / (len(LOSSES))) % TEST_FREQ == TEST_FREQ-1 or True:
@@ -270,7 +448,18 @@ def main():
                                         COMPLETE_TEST_FREQ == COMPLETE_TEST_FREQ-1)
                     model.train()
 
+                if STOP_SIGNALS or (flags.checkpoint_every and model.step - last_checkpoint >= flags.checkpoint_every):
+                    model.save_resume(training_state())
+                    last_checkpoint = model.step
+                    if STOP_SIGNALS:
+                        return
+
                 current_time = time()
+                # Time spent outside of this generator (e.g. training other runs) isn't counted in the throughput
+                meter.stop_training()
+                yield supervision_epoch, max_acc
+                meter.start_training()
+                fetch_start = time()
             data.reinit_iterator('valid')
             if model.step >= h_params.anneal_kl[0]:
                 model.eval()
@@ -297,6 +486,19 @@ def main():
             data.reinit_iterator('valid')
             data.reinit_iterator('unsup_valid')
             data.reinit_iterator('train')
+            model.reset_states()
+        model.metric_buffer.flush()
+        if flags.profile_steps:
+            timings_path = os.path.join(h_params.viz_path, 'step_timings.json')
+            model.timer.write_json(timings_path)
+            print("Step timings written to ", timings_path)
+        if flags.profile_vertices:
+            vertex_profiler.detach()
+            print(vertex_profiler.table())
+            trace_path = os.path.join(h_params.viz_path, 'vertex_trace.json')
+            os.makedirs(h_params.viz_path, exist_ok=True)
+            vertex_profiler.chrome_trace(trace_path)
+            print("Vertex trace written to ", trace_path)
         print("Finished training, starting final evaluation :")
     else:
 
@@ -314,26 +516,82 @@ def main():
     else:
         pp_ub = -1
     print("Final Test Accuracy is: {}, Final test perplexity is: {}".format(test_accuracy, pp_ub))
-    if not os.path.exists(flags.result_csv):
-        with open(flags.result_csv, 'w') as f:
-            f.write(', '.join(['test_name', 'dev_index', 'loss_type', 'supervision_proportion', 'generation_weight',
-                               'unsupervision_proportion', 'test_accuracy', 'dev_accuracy', 'train_accuracy',
-                               'pp_ub', 'best_epoch',
-                               'embedding_dim', 'pos_embedding_dim', 'z_size',
-                               'text_rep_l', 'text_rep_h', 'encoder_h', 'encoder_l',
-                               'pos_h', 'pos_l', 'decoder_h', 'decoder_l', 'training_iw_samples', 'is_tied', 'pretrained'
-                               ]) + '\n')
-
-    with open(flags.result_csv, 'a') as f:
-        f.write(', '.join([flags.test_name, str(flags.dev_index), flags.losses, str(flags.supervision_proportion),
-                           str(flags.generation_weight),
-                           str(flags.unsupervision_proportion), str(test_accuracy), str(max_acc),
-                           str(train_accuracy), str(pp_ub), str(best_epoch),
-                           str(flags.embedding_dim), str(flags.pos_embedding_dim), str(flags.z_size),
-                           str(flags.text_rep_l), str(flags.text_rep_h), str(flags.encoder_h), str(flags.encoder_l),
-                           str(flags.pos_h), str(flags.pos_l), str(flags.decoder_h), str(flags.decoder_l),
-                           str(flags.training_iw_samples), str(flags.tied_embeddings), str(flags.pretrained_embeddings)
-                           ])+'\n')
+    # Appended to the results database, from which the csv is re-exported (safe for concurrent runs of a sweep)
+    row = dict(zip(RESULT_COLUMNS, [flags.test_name, str(flags.dev_index), flags.losses,
+                                    str(flags.supervision_proportion), str(flags.generation_weight),
+                                    str(flags.unsupervision_proportion), str(test_accuracy), str(max_acc),
+                                    str(train_accuracy), str(pp_ub), str(best_epoch),
+                                    str(flags.embedding_dim), str(flags.pos_embedding_dim), str(flags.z_size),
+                                    str(flags.text_rep_l), str(flags.text_rep_h), str(flags.encoder_h),
+                                    str(flags.encoder_l), str(flags.pos_h), str(flags.pos_l), str(flags.decoder_h),
+                                    str(flags.decoder_l), str(flags.training_iw_samples), str(flags.tied_embeddings),
+                                    str(flags.pretrained_embeddings)]))
+    store = ResultStore(flags.result_csv)
+    store.append(dict(row, flags_hash=flags_hash(flags), **meter.row()))
+    store.close()
+    model.flush_saves()
+    model.remove_resume()
+
+
+def flags_hash(flags):
+    # Hash of all the flags of a run but the bookkeeping ones, stored in its result row
+    key = {name: value for name, value in vars(flags).items() if name not in BOOKKEEPING_FLAGS}
+    key['vocab_limit'] = VOCAB_LIMIT
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def is_done(flags):
+    # Whether the run already has a result row. Partially trained runs have no row, and resume from their checkpoint
+    # through the model's autoload.
+    keys, legacy_keys = finished_runs(flags.result_csv)
+    return (flags.test_name, flags_hash(flags)) in keys or result_key(flags) in legacy_keys
+
+
+def result_key(flags):
+    # (test_name, dev_index, loss_type, hyper-parameter hash) of a run, computed from the values written in its result
+    # row, to match the rows imported from a csv
+    hps = [str(flags.supervision_proportion), str(flags.generation_weight), str(flags.unsupervision_proportion),
+           str(flags.embedding_dim), str(flags.pos_embedding_dim), str(flags.z_size), str(flags.text_rep_l),
+           str(flags.text_rep_h), str(flags.encoder_h), str(flags.encoder_l), str(flags.pos_h), str(flags.pos_l),
+           str(flags.decoder_h), str(flags.decoder_l), str(flags.training_iw_samples), str(flags.tied_embeddings),
+           str(flags.pretrained_embeddings)]
+    return flags.test_name, str(flags.dev_index), flags.losses, hashlib.sha1(', '.join(hps).encode('utf-8')).hexdigest()
+
+
+def finished_runs(result_csv):
+    # Index of the runs that have a result row in the results database (created from the csv if needed): (test_name,
+    # flags_hash) keys, and result_key keys for the rows imported from a csv
+    if not os.path.exists(result_csv) and not os.path.exists(db_path(result_csv)):
+        return set(), set()
+    store = ResultStore(result_csv)
+    rows = store.rows(keys=True)
+    store.close()
+    keys, legacy_keys = set(), set()
+    for row in rows:
+        if row['flags_hash'] is not None:
+            keys.add((row['test_name'], row['flags_hash']))
+            continue
+        hps = ', '.join(str(row[column]) for column in RESULT_HP_COLUMNS)
+        legacy_keys.add((row['test_name'], row['dev_index'], row['loss_type'],
+                         hashlib.sha1(hps.encode('utf-8')).hexdigest()))
+    return keys, legacy_keys
+
+
+def warm_start_path(flags):
+    # Reconstruction phase checkpoints are addressed by a hash of everything they depend on (the supervised data, i.e.
+    # the fold and the supervision proportion, are left out since the phase is unsupervised with --warm_start)
+    key = {name: getattr(flags, name) for name in WARM_START_FLAGS}
+    key['vocab_limit'] = VOCAB_LIMIT
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(ROOT_CHECKPOINTING_PATH, 'warm_start', '{}_{}.pth'.format(flags.dataset, digest))
+
+
+def save_warm_start(model, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    torch.save({'model_checkpoint': model.state_dict(), 'step': model.step}, tmp_path)
+    os.replace(tmp_path, path)
+    print("Saved warm start checkpoint ", path)
 
 
 def limited_next(iterator):
@@ -345,6 +603,7 @@ def limited_next(iterator):
 
 
 if __name__ == '__main__':
+    set_flags()
     main()
 
 
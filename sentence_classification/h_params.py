@@ -58,6 +58,8 @@ class DefaultHParams:
         # A name to be used for checkpoints and Tensorboard logging indexation
         self.test_name = test_name
         self.save_path = os.path.join(ROOT_CHECKPOINTING_PATH, test_name+'.pth')
+        # Full training state (optimizer, RNG, data position, ...) to resume an interrupted run
+        self.resume_path = os.path.join(ROOT_CHECKPOINTING_PATH, test_name+'.resume.pth')
         self.viz_path = os.path.join(ROOT_TENSORBOARD_PATH, test_name)
 
         # Device hyper-parameter
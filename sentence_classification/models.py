@@ -1,12 +1,165 @@
 from torch.utils.tensorboard import SummaryWriter
 import torch
+import numpy as np
+import random
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import json
+from time import perf_counter
 from tqdm import tqdm
 
 from sentence_classification.h_params import *
 from components.bayesnets import BayesNet
+from components.links import LSTMLink
 from components.criteria import Supervision
 
 
+# ==================================================== METRIC BUFFER ===================================================
+
+class MetricBuffer:
+    # Keeps the scalar metrics of the last steps on their device, and writes them to the summary writer every
+    # flush_every steps after a single device to host transfer, so that logging doesn't synchronize every step.
+    # Steps are counted on the step values passed to add, whatever the number of metric groups logged per step.
+    def __init__(self, writer, flush_every=100):
+        self.writer = writer
+        self.flush_every = flush_every
+        self.entries = []
+        self.n_steps, self.last_step = 0, None
+
+    def add(self, prefix, metrics, step):
+        if not metrics:
+            return
+        if step != self.last_step:
+            # Flushing before the first entry of a new step, so that a step's metrics are written together
+            if self.n_steps and self.n_steps % self.flush_every == 0:
+                self.flush()
+            self.n_steps += 1
+            self.last_step = step
+        names = [prefix + name for name in metrics]
+        device = self.device(metrics)
+        values = torch.stack([torch.as_tensor(value, dtype=torch.float, device=device).detach().reshape(())
+                              for value in metrics.values()])
+        self.entries.append((step, names, values))
+
+    @staticmethod
+    def device(metrics):
+        for value in metrics.values():
+            if torch.is_tensor(value):
+                return value.device
+        return torch.device('cpu')
+
+    def flush(self):
+        if not self.entries:
+            return
+        device = self.entries[0][2].device
+        values = torch.cat([values.to(device) for _, _, values in self.entries]).cpu().tolist()
+        i = 0
+        for step, names, _ in self.entries:
+            for name in names:
+                self.writer.add_scalar(name, values[i], step)
+                i += 1
+        self.entries = []
+
+
+# ===================================================== STEP TIMERS ====================================================
+
+class StepTimer:
+    # Times the phases of opt_step: each lap(name) closes the phase opened by the previous lap (or by start). On GPUs,
+    # laps are CUDA events, which are only resolved when the timings are written, so that timing doesn't synchronize
+    # the steps. Durations are in milliseconds, per call of the phase.
+    def __init__(self, device, writer=None, flush_every=100):
+        self.cuda = device.type == 'cuda'
+        self.writer = writer
+        self.flush_every = flush_every
+        self.durations = collections.defaultdict(list)
+        self.written = collections.defaultdict(int)
+        self.pending = []
+        self.last = None
+        self.n_steps, self.tokens, self.first_step, self.last_step = 0, 0, None, None
+
+    def now(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return perf_counter()
+
+    def start(self):
+        self.last = self.now()
+
+    def lap(self, name):
+        now = self.now()
+        if self.cuda:
+            self.pending.append((name, self.last, now))
+        else:
+            self.durations[name].append((now - self.last) * 1e3)
+        self.last = now
+
+    def add(self, name, seconds):
+        # Phases timed on the host by the caller (e.g. waiting for the data)
+        self.durations[name].append(seconds * 1e3)
+
+    def step(self, n_tokens, step):
+        # Called once per training iteration, with the number of (non padding) tokens it trained on, possibly as a
+        # device tensor that is only read back when the timings are written. Throughput is measured from the first call
+        # on.
+        now = perf_counter()
+        if self.first_step is None:
+            self.first_step = now
+        else:
+            self.tokens += n_tokens
+            self.n_steps += 1
+        self.last_step = now
+        if self.writer is not None and self.n_steps and self.n_steps % self.flush_every == 0:
+            self.resolve()
+            for name, durations in self.durations.items():
+                if len(durations) > self.written[name]:
+                    self.writer.add_scalar('timing/{}_ms'.format(name), np.mean(durations[self.written[name]:]), step)
+                    self.written[name] = len(durations)
+            self.writer.add_scalar('timing/tokens_per_s', self.tokens_per_s(), step)
+
+    def resolve(self):
+        if self.pending:
+            self.pending[-1][2].synchronize()
+            for name, start, end in self.pending:
+                self.durations[name].append(start.elapsed_time(end))
+            self.pending = []
+
+    def tokens_per_s(self):
+        return float(self.tokens) / (self.last_step - self.first_step) if self.n_steps else 0.
+
+    def summary(self):
+        self.resolve()
+        total = sum(sum(durations) for durations in self.durations.values())
+        phases = {name: {'calls': len(durations), 'mean_ms': float(np.mean(durations)),
+                         'p50_ms': float(np.percentile(durations, 50)), 'p90_ms': float(np.percentile(durations, 90)),
+                         'p99_ms': float(np.percentile(durations, 99)), 'total_s': sum(durations) / 1e3,
+                         'share': sum(durations) / total if total else 0.}
+                  for name, durations in self.durations.items() if durations}
+        return {'phases': phases, 'steps': self.n_steps, 'tokens_per_s': self.tokens_per_s(),
+                'steps_per_s': self.n_steps / (self.last_step - self.first_step) if self.n_steps else 0.}
+
+    def write_json(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+class NullTimer:
+    # Stands for the StepTimer when timing is disabled
+    def start(self):
+        pass
+
+    def lap(self, name):
+        pass
+
+    def add(self, name, seconds):
+        pass
+
+    def step(self, n_tokens, step):
+        pass
+
+
 # ==================================================== SSPOSTAG MODEL CLASS ============================================
 
 class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
@@ -18,6 +171,11 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
                                              padding_idx=vocab_index.stoi['<pad>'])
         nn.init.uniform_(self.word_embeddings.weight, -1., 1.)
         if wvs is not None:
+            # wvs can be a tensor, an array (e.g. memory-mapped from the vector cache) or the path of a .npy file
+            if isinstance(wvs, str):
+                wvs = np.load(wvs, mmap_mode='r')
+            if not torch.is_tensor(wvs):
+                wvs = torch.from_numpy(np.array(wvs))
             self.word_embeddings.weight.data.copy_(wvs)
             UNK_IDX = vocab_index.stoi['<unk>']
             PAD_IDX = vocab_index.stoi['<pad>']
@@ -38,6 +196,11 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
         self.gen_bn = BayesNet(vertices['gen'])
         self.gen_last_states = None
         self.gen_last_states_sup = None
+        if h_params.contiguous_lm:
+            # The decoder's recurrent states are carried from one window of the packed stream to the next
+            for link in self.gen_bn.approximator.values():
+                if isinstance(link, LSTMLink) and not link.bidirectional and not link.last_state:
+                    link.carry_state = True
 
         # Setting up categorical variable indexes
         self.index = {self.generated_v: vocab_index, self.supervised_v: tag_index}
@@ -57,16 +220,32 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
 
         # Getting the Summary writer
         self.writer = SummaryWriter(h_params.viz_path)
+        self.metric_buffer = MetricBuffer(self.writer)
+        # Phase timings of opt_step, replaced by a StepTimer to enable them
+        self.timer = NullTimer()
         self.step = 0
 
+        # With async_save, save() keeps the best weights as an in-memory CPU snapshot (also used by load()) and writes
+        # it to disk in a background thread
+        self.async_save = False
+        self.best_snapshot = None
+        self.save_executor = None
+
         # Loading previous checkpoint if auto_load is set to True
         if autoload:
             self.load()
 
+    def reset_states(self):
+        # Forgets the recurrent states carried from one batch to the next with h_params.contiguous_lm (e.g. at the
+        # start of a pass over a packed stream)
+        self.infer_last_states, self.gen_last_states = None, None
+
     def opt_step(self, samples):
+        self.timer.start()
         if (self.step % self.h_params.grad_accumulation_steps) == 0:
             # Reinitializing gradients if accumulation is over
             self.optimizer.zero_grad()
+        self.timer.lap('optimizer')
 
         #                          ----------- Unsupervised Forward/Backward ----------------
         # Forward pass
@@ -81,15 +260,18 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
             else:
                 self.infer_last_states = self.infer_bn(infer_inputs, prev_states=self.infer_last_states, complete=True
                                                        , lens=x_len)
+            self.timer.lap('infer_forward')
             gen_inputs = {**{k.name: v for k, v in self.infer_bn.variables_hat.items()},
                           **{'x': samples['x'], 'x_prev': samples['x_prev']}}
             if self.iw:
                 gen_inputs, x_len = self._harmonize_input_shapes(gen_inputs, self.h_params.training_iw_samples, x_len)
+            self.timer.lap('harmonize')
             if self.step < self.h_params.anneal_kl[0]:
                 self.gen_last_states = self.gen_bn(gen_inputs, target=self.generated_v,
                                                    prev_states=self.gen_last_states, lens=x_len)
             else:
                 self.gen_last_states = self.gen_bn(gen_inputs, prev_states=self.gen_last_states, lens=x_len)
+            self.timer.lap('gen_forward')
 
             # Loss computation and backward pass
             losses_uns = [loss.get_loss() * loss.w for loss in self.losses if not isinstance(loss, Supervision)]
@@ -97,8 +279,10 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
             # Cleaning computation graph:
             self.gen_bn.clear_values()
             self.infer_bn.clear_values()
+            self.timer.lap('loss')
 
             sum(losses_uns).backward()
+            self.timer.lap('backward')
             if not self.h_params.contiguous_lm:
                 self.infer_last_states, self.gen_last_states = None, None
 
@@ -115,15 +299,18 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
             else:
                 self.infer_last_states_sup = self.infer_bn(infer_inputs, prev_states=self.infer_last_states_sup,
                                                            complete=True, lens=x_len)
+            self.timer.lap('infer_forward')
 
             gen_inputs = {**{k.name: v for k, v in self.infer_bn.variables_hat.items()}, **infer_inputs}
             if self.iw:
                 gen_inputs, x_len = self._harmonize_input_shapes(gen_inputs, self.h_params.training_iw_samples, x_len)
+            self.timer.lap('harmonize')
             if self.step < self.h_params.anneal_kl[0]:
                 self.gen_last_states = self.gen_bn(gen_inputs, target=self.generated_v,
                                                    prev_states=self.gen_last_states, lens=x_len)
             else:
                 self.gen_last_states = self.gen_bn(gen_inputs, prev_states=self.gen_last_states, lens=x_len)
+            self.timer.lap('gen_forward')
             # Loss computation and backward pass
             losses_sup = [(loss.get_loss() if isinstance(loss, Supervision)
                            else loss.get_loss(observed=[self.supervised_v.name])
@@ -133,9 +320,11 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
             # Cleaning computation graph:
             self.gen_bn.clear_values()
             self.infer_bn.clear_values()
+            self.timer.lap('loss')
             # torch.cuda.synchronize(self.h_params.device)
             # torch.cuda.ipc_collect()
             sum(losses_sup).backward()
+            self.timer.lap('backward')
 
         if (self.step % self.h_params.grad_accumulation_steps) == (self.h_params.grad_accumulation_steps-1):
             # Applying gradients and gradient clipping if accumulation is over
@@ -143,12 +332,15 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
                 torch.nn.utils.clip_grad_norm_(self.parameters(), self.h_params.grad_clip)
             self.optimizer.step()
         self.step += 1
+        self.timer.lap('optimizer')
 
         self._dump_train_viz()
+        self.timer.lap('viz')
         total_loss = (sum(losses_uns) if (self.generate and not(self.supervised_v.name in samples)) else 0) + \
                      (sum(losses_sup) if (self.supervise and self.supervised_v.name in samples) else 0)
 
-        return total_loss.item()
+        # Returned as a device tensor, so that the step doesn't wait for the device
+        return total_loss.detach()
 
     def forward(self, samples, eval=False, prev_states=None, force_iw=None, gen_this=True):
         # Just propagating values through the bayesian networks to get summaries
@@ -202,31 +394,27 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
         # Dumping gradient norm
         if (self.step % self.h_params.grad_accumulation_steps) == (self.h_params.grad_accumulation_steps - 1):
             z_gen = [var for var in self.gen_bn.variables if var.name == 'z'][0]
+            grad_norms = {}
             for module, name in zip([self, self.infer_bn, self.gen_bn,
                                      self.gen_bn.approximator[z_gen] if z_gen in self.gen_bn.approximator else None],
                                     ['overall', 'inference', 'generation', 'prior']):
                 if module is None: continue
-                grad_norm = 0
-                for p in module.parameters():
-                    if p.grad is not None:
-                        param_norm = p.grad.data.norm(2)
-                        grad_norm += param_norm.item() ** 2
-                grad_norm = grad_norm ** (1. / 2)
-                self.writer.add_scalar('train' + '/' + '_'.join([name, 'grad_norm']), grad_norm, self.step)
+                grads = [p.grad for p in module.parameters() if p.grad is not None]
+                if grads:
+                    grad_norms['/' + '_'.join([name, 'grad_norm'])] = torch.stack(torch._foreach_norm(grads)).norm()
+            self.metric_buffer.add('train', grad_norms, self.step)
 
         # Getting the interesting metrics: this model's loss and some other stuff that would be useful for diagnosis
         for loss in self.losses:
             if not isinstance(loss, Supervision) or self.is_supervised_batch:
-                for name, metric in loss.metrics().items():
-                    self.writer.add_scalar('train' + name, metric, self.step)
+                self.metric_buffer.add('train', loss.metrics(), self.step)
 
     def dump_test_viz(self, complete=False):
         if complete:
             print('Performing complete test')
         # Getting the interesting metrics: this model's loss and some other stuff that would be useful for diagnosis
         for loss in self.losses:
-            for name, metric in loss.metrics().items():
-                self.writer.add_scalar('test' + name, metric, self.step)
+            self.metric_buffer.add('test', loss.metrics(), self.step)
 
         summary_dumpers = {'scalar': self.writer.add_scalar, 'text': self.writer.add_text,
                            'image': self.writer.add_image}
@@ -346,8 +534,14 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
                          gen_this=False)
 
                     num_classes = self.supervised_v.size
-                    predictions = self.supervised_v.post_params['logits'].reshape(-1, num_classes)
-                    target = self.infer_bn.variables_star[self.supervised_v].view(-1)
+                    predictions = self.supervised_v.post_params['logits']
+                    target = self.infer_bn.variables_star[self.supervised_v]
+                    if self.supervised_v.sequence_lv:
+                        # Sentence level labels are repeated along the sequence, counting them once per example
+                        # keeps the accuracy independent of the batch's padded length
+                        predictions, target = predictions[..., :1, :], target[..., :1]
+                    predictions = predictions.reshape(-1, num_classes)
+                    target = target.reshape(-1)
                     prediction_mask = (target != self.supervised_v.ignore).float()
                     accurate_preds += torch.sum((torch.argmax(predictions, dim=-1) == target).float() * prediction_mask)
 
@@ -363,6 +557,13 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
                 return self.step/1e6
 
     def save(self):
+        if self.async_save:
+            self.best_snapshot = {'model_checkpoint': {k: v.detach().to('cpu', copy=True)
+                                                       for k, v in self.state_dict().items()}, 'step': self.step}
+            if self.save_executor is None:
+                self.save_executor = ThreadPoolExecutor(max_workers=1)
+            self.save_executor.submit(self.write_snapshot)
+            return
         root = ''
         for subfolder in self.h_params.save_path.split(os.sep)[:-1]:
             root = os.path.join(root, subfolder)
@@ -371,7 +572,31 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
         torch.save({'model_checkpoint': self.state_dict(), 'step': self.step}, self.h_params.save_path)
         print("Model {} saved !".format(self.h_params.test_name))
 
+    def write_snapshot(self):
+        # Writes the latest snapshot (older ones still queued are skipped), through a temporary file so that the
+        # checkpoint on disk is never a partial one
+        snapshot = self.best_snapshot
+        if snapshot is None or snapshot.get('written'):
+            return
+        os.makedirs(os.path.dirname(self.h_params.save_path) or '.', exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.h_params.save_path, os.getpid())
+        torch.save({'model_checkpoint': snapshot['model_checkpoint'], 'step': snapshot['step']}, tmp_path)
+        os.replace(tmp_path, self.h_params.save_path)
+        snapshot['written'] = True
+        print("Model {} saved in the background !".format(self.h_params.test_name))
+
+    def flush_saves(self):
+        # Waits for the background writes to be over
+        if self.save_executor is not None:
+            self.save_executor.shutdown(wait=True)
+            self.save_executor = None
+
     def load(self):
+        if self.best_snapshot is not None:
+            self.load_state_dict(self.best_snapshot['model_checkpoint'])
+            self.step = self.best_snapshot['step']
+            print("Loaded in-memory snapshot at step", self.step)
+            return
         if os.path.exists(self.h_params.save_path):
             checkpoint = torch.load(self.h_params.save_path)
             model_checkpoint, self.step = checkpoint['model_checkpoint'], checkpoint['step']
@@ -380,6 +605,43 @@ class SSSentenceClassification(nn.Module, metaclass=abc.ABCMeta):
         else:
             print("Save file doesn't exist, the model will be trained from scratch.")
 
+    def save_resume(self, training_state):
+        # Everything needed to continue training exactly where it stopped, training_state holding the training loop's
+        # counters and data iterator positions. Written to a temporary file first, so that a run killed while saving
+        # keeps its previous resume checkpoint.
+        os.makedirs(os.path.dirname(self.h_params.resume_path) or '.', exist_ok=True)
+        # (numpy states are stored as plain lists, which torch.load accepts with weights_only)
+        numpy_state = np.random.get_state()
+        rng = {'torch': torch.get_rng_state(), 'python': random.getstate(),
+               'numpy': (numpy_state[0], numpy_state[1].tolist()) + tuple(numpy_state[2:]),
+               'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+        tmp_path = '{}.{}.tmp'.format(self.h_params.resume_path, os.getpid())
+        torch.save({'model_checkpoint': self.state_dict(), 'step': self.step,
+                    'optimizer': self.optimizer.state_dict(), 'rng': rng, 'training_state': training_state}, tmp_path)
+        os.replace(tmp_path, self.h_params.resume_path)
+        print("Saved resume checkpoint of {} at step {}".format(self.h_params.test_name, self.step))
+
+    def load_resume(self):
+        # Returns the saved training state, or None if there is no resume checkpoint
+        if not os.path.exists(self.h_params.resume_path):
+            return None
+        checkpoint = torch.load(self.h_params.resume_path, map_location=self.h_params.device)
+        self.load_state_dict(checkpoint['model_checkpoint'])
+        self.step = checkpoint['step']
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        rng = checkpoint['rng']
+        torch.set_rng_state(rng['torch'].cpu())
+        np.random.set_state(rng['numpy'])
+        random.setstate(rng['python'])
+        if rng['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([state.cpu() for state in rng['cuda']])
+        print("Resumed training state at step", self.step)
+        return checkpoint['training_state']
+
+    def remove_resume(self):
+        if os.path.exists(self.h_params.resume_path):
+            os.remove(self.h_params.resume_path)
+
     def reduce_lr(self, factor):
         for param_group in self.optimizer.param_groups:
             param_group['lr'] /= factor
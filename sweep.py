@@ -0,0 +1,218 @@
+# This file runs a sweep of sent_train.py experiments in a single process: the interpreter, torch and the datasets
+# (token cache, vocabulary and pretrained vectors) are loaded once, and each run only builds its own splits, model and
+# iterators. Results are appended to each run's --result_csv exactly as with sent_train.py.
+# With --halving, each rung's (partial) results also go to the results database of each run's --result_csv, and
+# "python results.py <result_csv> --rungs" exports them.
+# With --jobs N, runs are packed on N processes with their own CPU cores (and torch thread budget), and queued by
+# decreasing expected cost.
+# Examples:
+#   python sweep.py --script launch_scripts/launchSSIWAEIMDB.slurm
+#   python sweep.py --base "--losses SSIWAE --batch_size 32 --grad_accu 2 --dataset imdb --result_csv imdb4.csv" \
+#       --grid supervision_proportion=0.001,0.003 dev_index=1,2,3,4,5 \
+#       --name_template "IMDB4/SSIWAE/{supervision_proportion}small{dev_index}"
+import argparse
+import gc
+import inspect
+import itertools
+import math
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import shlex
+import traceback
+from time import time
+
+import torch
+
+import sent_train
+from results import ResultStore
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--script", default=None, type=str)  # launch script whose sent_train.py command lines are run
+parser.add_argument("--base", default='', type=str)  # sent_train.py flags shared by all the runs of the grid
+parser.add_argument("--grid", default=[], nargs='*', type=str)  # flag=value1,value2,... entries, crossed together
+parser.add_argument("--name_template", default=None, type=str)  # --test_name of grid runs, formatted with their values
+parser.add_argument("--jobs", default=1, type=int)  # runs executed concurrently, in processes forked after loading
+parser.add_argument("--cores_per_job", default=None, type=int)  # CPU cores pinned to each job, default: cores/jobs
+# Successive halving: all the runs train for rung_epochs supervision epochs, then only the best 1/halving_eta (by dev
+# accuracy) go on for halving_eta times more epochs, and so on. Stopped runs keep their best checkpoint. The runs of a
+# rung are interleaved in this process, which holds all their models, optimizers and iterators at once (--jobs must
+# be 1).
+parser.add_argument('--halving', dest='halving', action='store_true')
+parser.add_argument('--no-halving', dest='halving', action='store_false')
+parser.set_defaults(halving=False)
+parser.add_argument("--rung_epochs", default=2, type=int)
+parser.add_argument("--halving_eta", default=3, type=int)
+
+# Approximate number of unsupervised training examples of each dataset, used to order the jobs by expected cost
+UNSUP_SIZES = {'imdb': 50000, 'ag_news': 64000, 'yelp': 433000, 'ud': 12500}
+IW_LOSSES = ('SSPIWO', 'SSiPIWO', 'SSIWAE')
+
+
+def script_runs(path):
+    # Argument lists of the sent_train.py command lines of a launch script
+    runs = []
+    with open(path) as f:
+        for line in f:
+            tokens = shlex.split(line, comments=True)
+            if 'sent_train.py' in tokens:
+                runs.append(tokens[tokens.index('sent_train.py')+1:])
+    return runs
+
+
+def grid_runs(base, grid, name_template=None):
+    # Argument lists of the cartesian product of the grid's values, on top of the base flags
+    keys = [entry.split('=', 1)[0] for entry in grid]
+    values = [entry.split('=', 1)[1].split(',') for entry in grid]
+    runs = []
+    for combination in itertools.product(*values):
+        args = shlex.split(base)
+        for key, value in zip(keys, combination):
+            args += ['--'+key, value]
+        if name_template is not None:
+            args += ['--test_name', name_template.format(**dict(zip(keys, combination)))]
+        runs.append(args)
+    return runs
+
+
+def preload(runs):
+    # Loads each dataset of the sweep once (on CPU, so that CUDA isn't initialized before forking)
+    loaded = set()
+    for args in runs:
+        flags = sent_train.parser.parse_args(args)
+        key = (flags.dataset, flags.max_len, flags.pretrained_embeddings, flags.shared_data)
+        if key in loaded:
+            continue
+        loaded.add(key)
+        sent_train.DATASETS[flags.dataset](flags.max_len, flags.batch_size, flags.n_epochs, torch.device('cpu'),
+                                           flags.unsupervision_proportion, flags.supervision_proportion,
+                                           flags.dev_index, flags.pretrained_embeddings, shared=flags.shared_data)
+
+
+def run(args):
+    # A failing run is reported and the sweep goes on, like the independent lines of a launch script
+    start = time()
+    try:
+        sent_train.set_flags(args)
+        sent_train.main()
+    except Exception:
+        traceback.print_exc()
+        print("Run failed: ", ' '.join(args))
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    print("Run took {} seconds: {}".format(time() - start, ' '.join(args)))
+
+
+def run_cost(args):
+    # Expected cost of a run, proportional to its tokens per epoch times the forward passes they go through
+    flags = sent_train.parser.parse_args(args)
+    tokens = UNSUP_SIZES[flags.dataset] * flags.unsupervision_proportion * flags.max_len
+    passes = 1 + (0 if flags.losses == 'S' else flags.training_iw_samples if flags.losses in IW_LOSSES else 1)
+    return tokens * passes
+
+
+def pinned_run(args, cpus):
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+    run(args)
+
+
+def schedule(runs, n_jobs, cores_per_job=None):
+    # Packs the runs on n_jobs slots with fixed CPU sets, starting the most expensive runs first so that the long
+    # ones don't end up alone at the end of the sweep
+    cpus = sorted(os.sched_getaffinity(0))
+    cores_per_job = cores_per_job or max(1, len(cpus) // n_jobs)
+    slots = [[cpus[(i*cores_per_job + j) % len(cpus)] for j in range(cores_per_job)] for i in range(n_jobs)]
+    queue = sorted(runs, key=run_cost, reverse=True)
+    context = multiprocessing.get_context('fork')
+    running = {}
+    while queue or running:
+        for slot in range(n_jobs):
+            if slot not in running and queue:
+                running[slot] = context.Process(target=pinned_run, args=(queue.pop(0), slots[slot]))
+                running[slot].start()
+        wait([process.sentinel for process in running.values()])
+        for slot, process in list(running.items()):
+            if not process.is_alive():
+                process.join()
+                del running[slot]
+
+
+def record_rung(run, rung, status):
+    # Appended to the results database of the run's --result_csv (safe for concurrent sweeps)
+    store = ResultStore(run['flags'].result_csv)
+    store.append_rung({'test_name': run['flags'].test_name, 'dev_index': run['flags'].dev_index,
+                       'loss_type': run['flags'].losses, 'supervision_proportion': run['flags'].supervision_proportion,
+                       'rung': rung, 'supervision_epoch': run['epoch'], 'dev_accuracy': run['acc'], 'status': status})
+    store.close()
+
+
+def stop_live_runs(live):
+    # On SIGTERM or SIGUSR1, each suspended run is resumed so that it writes its resume checkpoint and returns. Runs
+    # that haven't started yet have nothing to save.
+    for run in live:
+        if inspect.getgeneratorstate(run['steps']) == inspect.GEN_CREATED:
+            continue
+        sent_train.set_flags(run['args'])
+        for _ in run['steps']:
+            pass
+
+
+def successive_halving(runs, rung_epochs, eta):
+    # The runs are experiment generators of this process. The module settings of sent_train are set back to each run's
+    # before resuming it. Runs that finish on their own write their result rows as usual.
+    live = []
+    for args in runs:
+        flags = sent_train.set_flags(args)
+        if flags.skip_done and sent_train.is_done(flags):
+            print("Skipping {}: it already has a result row in {}".format(flags.test_name, flags.result_csv))
+            continue
+        live.append({'args': args, 'flags': flags, 'steps': sent_train.experiment(flags), 'epoch': 0, 'acc': 0.})
+    target, rung = rung_epochs, 0
+    while live:
+        for run in list(live):
+            while run['epoch'] < target:
+                sent_train.set_flags(run['args'])
+                try:
+                    run['epoch'], run['acc'] = next(run['steps'])
+                except StopIteration:
+                    live.remove(run)
+                    if sent_train.STOP_SIGNALS:
+                        stop_live_runs(live)
+                        sent_train.exit_if_stopped()
+                    record_rung(run, rung, 'finished')
+                    break
+        live.sort(key=lambda run: run['acc'], reverse=True)
+        n_kept = int(math.ceil(len(live) / eta))
+        for run in live[n_kept:]:
+            run['steps'].close()
+            record_rung(run, rung, 'stopped')
+            print("Stopped {} at rung {} with dev accuracy {}".format(run['flags'].test_name, rung, run['acc']))
+        live = live[:n_kept]
+        for run in live:
+            record_rung(run, rung, 'promoted')
+        # The last run standing trains until its own stopping criterion
+        target, rung = target * eta if len(live) > 1 else math.inf, rung + 1
+
+
+def main():
+    sweep_flags = parser.parse_args()
+    if sweep_flags.halving and sweep_flags.jobs > 1:
+        parser.error("--halving runs all the rungs in a single process, it can't be used with --jobs > 1")
+    runs = script_runs(sweep_flags.script) if sweep_flags.script is not None else []
+    if sweep_flags.grid:
+        runs += grid_runs(sweep_flags.base, sweep_flags.grid, sweep_flags.name_template)
+    print("Sweep of {} runs".format(len(runs)))
+    preload(runs)
+    if sweep_flags.halving:
+        successive_halving(runs, sweep_flags.rung_epochs, sweep_flags.halving_eta)
+    elif sweep_flags.jobs > 1:
+        schedule(runs, sweep_flags.jobs, sweep_flags.cores_per_job)
+    else:
+        for args in runs:
+            run(args)
+
+
+if __name__ == '__main__':
+    main()